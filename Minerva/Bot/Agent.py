@@ -260,6 +260,10 @@ class VSAgent(Agent):
         m = msg or self._get_random_string_constant('start')
         return self.ask(m)
 
+    def apologize_unavailable(self, service):
+        """Says that service cannot be reached, so there is no full answer."""
+        return self.say(self._get_random_string_constant('unavailable').format(service))
+
 
 #Deprecated
 class ConsoleAgent(Agent):
@@ -41,6 +41,12 @@ START = [
     "What can I do for you?"
 ]
 
+UNAVAILABLE = [
+    # {0} is the service that could not be reached.
+    "I'm having trouble reaching {0} right now.  Please try again in a minute.",
+    "It looks like {0} isn't responding at the moment, so I can't answer that fully.  Please try again shortly."
+]
+
 CLARIFY = [
     "Are you asking about",
     "Which is your main point of interest"
@@ -55,6 +61,7 @@ ALL_STRINGS = {
     'negative_acks': NEGATIVE_ACKS,
     'end': END,
     'suggest_urls': SUGGEST_URLS,
+    'unavailable': UNAVAILABLE,
     'yes': YES_WORDS,
     'no': NO_WORDS
 }
\ No newline at end of file
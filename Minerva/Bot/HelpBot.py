@@ -1,6 +1,7 @@
 import types
 import functools
 import itertools
+import os
 import sys
 import json
 from enum import Enum, unique
@@ -10,6 +11,9 @@ import InfoManager
 import LuisInterpreter
 import LuisClient
 import Query
+import resilience
+import StateCodec
+import StateCompression
 
 
 def on_message(msg, system):
@@ -19,6 +23,41 @@ def on_message(msg, system):
     bot_convo = Conversation(system, msg)
     bot_convo.choose_action()
 
+async def on_message_async(msg, system):
+    """A coroutine that does what on_message() does.
+
+    LUIS, StackExchange, the state store and the connector are called
+    with coroutines, so the event loop can work other conversations while
+    this one waits on them.
+
+    """
+    bot_convo = Conversation(system, msg)
+    await bot_convo.choose_action_async()
+
+def awaits_reply(msg):
+    """True when msg's conversation is waiting for the user to pick an option or answer yes or no.
+
+    Such a message answers the bot's question, so later messages must not
+    be merged into it.
+
+    """
+    if not msg.data:
+        return False
+    data = codec.loads(StateCompression.unpack(msg.data), lazy=LAZY_KEYS)
+    status = data.get('interpreter', {}).get('status')
+    return status in (LuisInterpreter.InterpreterStatus.WaitingToStay,
+                      LuisInterpreter.InterpreterStatus.WaitingToContinue)
+
+def preload(system):
+    """Loads the read-only data that every conversation about system uses.
+
+    Called before a server forks its workers, so they share the data
+    instead of each loading its own copy.
+
+    """
+    InfoManager.ProjectSystemInfoManager(system)
+    LuisInterpreter.english_stopwords()
+
 def load_next_message(msg):
     """Returns the next message in queue."""
     queue = msg.data['queue']
@@ -65,8 +104,25 @@ class Conversation:
         luis_data = LuisData(json_results)
         return luis_data
 
+    async def query_luis_async(self, query_text):
+        """A coroutine that does what query_luis() does."""
+        luis_client = LuisClient.BotLuisClient('Petricca')
+        return LuisData(await luis_client.query_raw_async(query_text))
+
     def choose_action(self):
-       
+        # State writes made while interpreting are flushed once, at the end.
+        with self.msg.state_session():
+            self._choose_action()
+
+    async def choose_action_async(self):
+        """A coroutine that does what choose_action() does."""
+        async with self.msg.state_session():
+            await self._choose_action_async()
+
+    def _choose_action(self):
+        # The variable log's base snapshot is kept in the conversation's snapshot data.
+        self.msg.load_data(snapshot_data=True)
+
         # Deserialize to create instances of custom types.
         self._deserialize_data()
 
@@ -75,24 +131,50 @@ class Conversation:
 
         # Load data.
         #self.convo_data = self._load_conversation_data()
-        self.luis_data = self._load_luis_data()
-        self.interp_data = self._load_interpreter_data()
-        self.interp_data['luis_data'] = self.luis_data
+        try:
+            self.luis_data = self._load_luis_data()
+        except resilience.FAILURES:
+            # Without LUIS the message cannot be understood; keep the state for a retry.
+            self.msg.post(self.agent.apologize_unavailable('my language service'))
+            return
+        self._start_interpretation()
 
         # Interpret.
-        self.interpreter = LuisInterpreter.ApiProjectSystemLuisInterpreter(self.agent, self.project_system)
         self.interp_data = self.interpreter.interpret(self.interp_data)
         
         # Post-interpretation administrative tasks.
         self._send_outgoing()
 
         # Cleanup.
+        self._clean_up()
+        return
+
+    async def _choose_action_async(self):
+        await self.msg.load_data_async(snapshot_data=True)
+        self._deserialize_data()
+        try:
+            self.luis_data = await self._load_luis_data_async()
+        except resilience.FAILURES:
+            await self.msg.post_async(self.agent.apologize_unavailable('my language service'))
+            return
+        self._start_interpretation()
+        self.interp_data = await self.interpreter.interpret_async(self.interp_data)
+        await self._send_outgoing_async()
+        self._clean_up()
+
+    def _start_interpretation(self):
+        """Loads the interpreter data and creates the interpreter."""
+        self.interp_data = self._load_interpreter_data()
+        self.interp_data['luis_data'] = self.luis_data
+        self.interpreter = LuisInterpreter.ApiProjectSystemLuisInterpreter(self.agent, self.project_system)
+
+    def _clean_up(self):
+        """Clears the state of a finished query, or saves it for the next turn."""
         if self.interp_data['status'] in [LuisInterpreter.InterpreterStatus.Complete, LuisInterpreter.InterpreterStatus.Failed]:
             # Delete the state information.
             self._delete_state_information()
         else:
             self._save_all_data()
-        return
       
     def _save_interpreter_data(self):
         """Saves the conversation's interpreter data."""
@@ -110,15 +192,20 @@ class Conversation:
         print("VARIABLES when being saved:")
         print(json.dumps(self.interp_data['variables'], cls=DataEncoder, indent=4, sort_keys=True))
         print("STATUS on save: {}".format(self.interp_data['status']))
-        self.msg.data['interpreter'] = self.interp_data
+        # Variables are saved as changes to the log's base snapshot, and luis
+        # data is saved once, beside the interpreter data.
+        self.variable_log.record(self.interp_data['variables'])
+        self.msg.snapshot_data[VariableLog.BASE_KEY] = self.variable_log.base
+        self.msg.data['variables'] = self.variable_log.deltas()
+        self.msg.data['interpreter'] = {k: v for k, v in self.interp_data.items() if k not in ('variables', 'luis_data')}
         self.msg.data['luis_data'] = self.luis_data
-        self.msg.data = json.dumps(self.msg.data, cls=DataEncoder)
-        self.msg.save_data()
+        self.msg.data = StateCompression.pack(codec.dumps(self.msg.data))
+        self.msg.save_data(include_snapshot_data=True)
 
     def _deserialize_data(self):
         """Deserializes a help bot data encoded json."""
         if self.msg.data:
-            self.msg.data = json.loads(self.msg.data, object_hook=DataEncoder.decode_hook)
+            self.msg.data = codec.loads(StateCompression.unpack(self.msg.data), lazy=LAZY_KEYS)
 
     def _load_conversation_data(self):
         try:
@@ -135,8 +222,25 @@ class Conversation:
             interp_data = {'status': LuisInterpreter.InterpreterStatus.Pending}
         finally:
             interp_data.update({'msg_text': self.msg.text})
+            self._load_variables(interp_data)
             return interp_data
 
+    def _load_variables(self, interp_data):
+        """Replays the conversation's variable log into interp_data."""
+        self.variable_log = VariableLog(self.msg.snapshot_data.get(VariableLog.BASE_KEY),
+                                        self.msg.data.get('variables'))
+        if 'variables' in interp_data:
+            # Saved before variables were logged.
+            self.variable_log.restart(interp_data['variables'])
+            return
+        variables = self.variable_log.replay()
+        if variables is not None:
+            interp_data['variables'] = variables
+        else:
+            # The deltas do not belong to the stored base, so start over.
+            self.variable_log.restart()
+            interp_data['status'] = LuisInterpreter.InterpreterStatus.Pending
+
     def _save_luis_data(self):
         self.msg.data['luis_data'] = self.luis_data
         self.msg.save_data()
@@ -148,6 +252,12 @@ class Conversation:
             luis_data = self.query_luis(self.msg.text)
         return luis_data
 
+    async def _load_luis_data_async(self):
+        try:
+            return self.msg.data['luis_data']
+        except KeyError:
+            return await self.query_luis_async(self.msg.text)
+
     def _send_outgoing(self):
         """Sends any messages added to the outgoing list during interpretation."""
         try:
@@ -155,15 +265,30 @@ class Conversation:
         except KeyError:
             pass
         else:
-            for m in outbox:
-                self.msg.post(m)
+            # Sent as one activity when possible.
+            with self.msg.outbox():
+                for m in outbox:
+                    self.msg.post(m)
             # Cleanup.
             del self.interp_data['outgoing']
 
+    async def _send_outgoing_async(self):
+        """A coroutine that does what _send_outgoing() does."""
+        try:
+            outbox = self.interp_data['outgoing']
+        except KeyError:
+            pass
+        else:
+            async with self.msg.outbox():
+                for m in outbox:
+                    await self.msg.post_async(m)
+            del self.interp_data['outgoing']
+
     def _delete_state_information(self):
         """Clears out any state information for msg's conversation."""
         self.msg.data = {}
-        self.msg.save_data()
+        self.msg.snapshot_data.pop(VariableLog.BASE_KEY, None)
+        self.msg.save_data(include_snapshot_data=True)
 
     # Methods to handle message's conversation's state.
     def _has_active_query(self, msg):
@@ -217,28 +342,139 @@ class Conversation:
             msg.save_data()
 
 
+class VariableLog:
+
+    """Persists interpreter variables as a base snapshot plus per-turn deltas.
+
+    The base is an encoded snapshot of every variable, kept in the
+    conversation's snapshot data where it is only rewritten on compaction.
+    Each turn appends a small delta of the variables that changed or were
+    removed, which is kept with the rest of the conversation data.  The
+    deltas are folded back into a new base once there are more than
+    MAX_DELTAS of them, or once they are larger than the base itself.
+
+    """
+
+    BASE_KEY = 'interpreter_base'
+    MAX_DELTAS = 8
+
+    def __init__(self, base=None, deltas=None):
+        self.base = base
+        deltas = deltas or {}
+        self._base_version = deltas.get('base_version')
+        self._deltas = deltas.get('deltas', [])
+        self._fingerprints = {}
+        # The newest base version seen, so that a new base never reuses one.
+        self._latest_version = self._base_version or 0
+        # Set by restart() without variables; the next record() compacts.
+        self._restarting = False
+
+    def replay(self):
+        """Returns the logged variables, or None if the deltas do not fit the base."""
+        if self.base is None:
+            return None
+        base = codec.loads(StateCompression.unpack(self.base), lazy=LAZY_KEYS)
+        self._latest_version = max(self._latest_version, base['version'])
+        if base['version'] != self._base_version:
+            return None
+        # Deltas hold Deferred values too, which only a LazyDict resolves.
+        variables = StateCodec.LazyDict(base['variables'])
+        for delta in self._deltas:
+            variables.update(delta.get('set', {}))
+            for key in delta.get('unset', []):
+                variables.pop(key, None)
+        self._fingerprints = self._fingerprint_all(variables)
+        return variables
+
+    def restart(self, variables=None):
+        """Discards the log and starts again from variables, or from those next recorded."""
+        if variables is None:
+            self._deltas = []
+            self._fingerprints = {}
+            self._restarting = True
+        else:
+            self._compact(variables)
+
+    def record(self, variables):
+        """Logs the changes made to variables since they were replayed."""
+        if self._restarting or self.base is None or self._base_version is None:
+            self._compact(variables)
+            return
+        fingerprints = self._fingerprint_all(variables)
+        delta = {}
+        changed = {k: variables[k] for k, f in fingerprints.items() if self._fingerprints.get(k) != f}
+        removed = [k for k in self._fingerprints if k not in variables]
+        if changed:
+            delta['set'] = changed
+        if removed:
+            delta['unset'] = removed
+        if delta:
+            self._deltas.append(delta)
+        self._fingerprints = fingerprints
+
+        deltas_size = len(json.dumps(self._deltas, cls=DataEncoder))
+        if len(self._deltas) > VariableLog.MAX_DELTAS or deltas_size > len(self.base):
+            self._compact(variables)
+
+    def deltas(self):
+        """Returns the serializable deltas to save with the conversation data."""
+        return {'base_version': self._base_version, 'deltas': self._deltas}
+
+    def _compact(self, variables):
+        self._latest_version += 1
+        self._base_version = self._latest_version
+        self._restarting = False
+        self.base = StateCompression.pack(codec.dumps({'version': self._base_version, 'variables': variables}))
+        self._deltas = []
+        self._fingerprints = self._fingerprint_all(variables)
+
+    def _fingerprint_all(self, variables):
+        return {k: json.dumps(v, cls=DataEncoder, sort_keys=True) for k, v in variables.items()}
+
+
 class LuisData:
 
+    """The results of a LUIS query.
+
+    The entity attributes, and the attributes built from them, are only
+    filtered out of the raw json when they are first read.
+
+    """
+
+    # Composite attribute: the entity attributes it joins.
+    _COMPOSITES = {
+        'all_jargon': ('jargon_single', 'jargon_phrase', 'jargon_debugging'),
+        'learn_about_triggers': ('learn_about_phrases', 'learn_about_singles'),
+    }
+
     def __init__(self, json_, attrs=None):
         self.json_ = json_
         self.entities = json_['entities']
         self.intents = json_['intents']
         self.query = json_['query']
 
-        # Set an attr for each entity in the model's entity schema.
-        for attr_name, entity_label in LuisClient.MODEL_ENTITY_SCHEMA.items():
-            self._set_entity_attr(attr_name, entity_label)
-
-        # Composite attributes.
-        self.all_jargon = self.jargon_single + self.jargon_phrase + self.jargon_debugging
-        self.learn_about_triggers = self.learn_about_phrases + self.learn_about_singles
-
-        # Additional setup.
-        self._initialize_attrs()
-        
         # Handle optional params.
-        self.words_of_interest = self.set_from_attrs(attrs) if attrs else None
-        self._attrs_of_interest = attrs
+        self._attrs_of_interest = attrs if attrs else None
+        self._words_of_interest = None
+
+    def __getattr__(self, name):
+        # Set an attr for each entity in the model's entity schema, when first read.
+        if name in LuisClient.MODEL_ENTITY_SCHEMA:
+            self._set_entity_attr(name, LuisClient.MODEL_ENTITY_SCHEMA[name])
+            self._initialize_attr(name)
+        elif name in LuisData._COMPOSITES:
+            self.__setattr__(name, list(itertools.chain.from_iterable(
+                getattr(self, attr) for attr in LuisData._COMPOSITES[name])))
+        else:
+            raise AttributeError("'LuisData' object has no attribute '{}'".format(name))
+        return self.__dict__[name]
+
+    @property
+    def words_of_interest(self):
+        """The set of all values for each attr of interest, or None."""
+        if self._words_of_interest is None and self._attrs_of_interest is not None:
+            self._words_of_interest = self.set_from_attrs(self._attrs_of_interest)
+        return self._words_of_interest
 
     def _add_lists(self, first, second):
         if not first and second:
@@ -255,10 +491,10 @@ class LuisData:
         self.__setattr__(attr_name, entity_literals or [])
         print("Set {} to {}".format(attr_name, getattr(self, attr_name)))
         
-    def _initialize_attrs(self):
-        """Handle any special formatting for any attribute that needs it."""
+    def _initialize_attr(self, attr_name):
+        """Handle any special formatting for an attribute that needs it."""
         # LUIS adds whitespace between nonalpha characters.
-        if self.languages:
+        if attr_name == 'languages' and self.languages:
             self.languages = list(map(lambda e: e.replace(' ', ''), self.languages))
 
     def set_from_attrs(self, attrs):
@@ -270,8 +506,8 @@ class LuisData:
 
     def load_words_of_interest(self, attrs):
         """Updates words_of_interest based on attrs."""
-        self.words_of_interest = self.set_from_attrs(attrs)
         self._attrs_of_interest = attrs
+        self._words_of_interest = None
 
     def top_intent(self):
         try:
@@ -282,42 +518,44 @@ class LuisData:
 
 #region JSON Encoding/Decoding
 
+def _decode_topic_match(data):
+    match = InfoManager.TopicMatch(data['topic'], data['score'])
+    match.path = data['path']
+    return match
+
+# The codec for all help bot state.  Every type that may appear in
+# interpreter variables must be registered here.
+codec = StateCodec.Codec(os.environ.get('STATE_CODEC', 'json'))
+codec.register_enum(LuisInterpreter.InterpreterStatus, LuisInterpreter.Next, LuisInterpreter.SubstringLibrary,
+                    LuisInterpreter.DebugTopic, LuisInterpreter.Intent, Query.CharType, Query.QueryPaths)
+codec.register(set, "__set__", StateCodec.encode_set, StateCodec.decode_set)
+codec.register(InfoManager.TopicMatch, "__TopicMatch__",
+               lambda m: {'topic': m.topic, 'score': m.score, 'path': m.path}, _decode_topic_match)
+codec.register(LuisData, "__LuisData__", lambda d: d.json_, LuisData)
+codec.register(Query.QuestionResult, "__QuestionResult__",
+               Query.QuestionResult.compact, Query.QuestionResult.from_compact)
+codec.register(Query.StackExchangeResponse, "__StackExchangeResponse__",
+               Query.StackExchangeResponse.compact, Query.StackExchangeResponse.from_compact)
+# Queries are not rebuilt from state; their repr is kept for debugging.
+codec.register(Query.StackExchangeQuery, "__StackExchangeQuery__", repr)
+
+# Keys whose values are only decoded when a procedure reads them.
+LAZY_KEYS = ('luis_data', 'query_response', 'top_matches')
+
+
 class DataEncoder(json.JSONEncoder):
 
-    """A customized json encoder for help bot data."""
+    """A customized json encoder for help bot data, backed by codec."""
 
     def default(self, obj):
-        if isinstance(obj, Enum):
-            return {"__enum__": str(obj)}
-        elif isinstance(obj, set):
-            return {"__set__": str(obj)}
-        elif isinstance(obj, InfoManager.TopicMatch):
-            return {"__TopicMatch__": dict(obj)}
-        elif isinstance(obj, Query.StackExchangeResponse):
-            return {"__StackExchangeResponse__": obj._json}
-        elif isinstance(obj, Query.StackExchangeQuery):
-            return {"__StackExchangeQuery__": repr(obj)}
-        elif isinstance(obj, Query.QuestionResult):
-            return {"__QuestionResult__": obj.serialize()}
-        elif isinstance(obj, LuisData):
-            return {"__LuisData__": obj.json_}
-        return json.JSONEncoder.default(self, obj)
+        try:
+            return codec.default(obj)
+        except TypeError:
+            return json.JSONEncoder.default(self, obj)
 
     @classmethod
     def decode_hook(cls, obj):
-        if "__enum__" in obj:
-            name, member = obj["__enum__"].split('.')
-            mod = globals()['LuisInterpreter']
-            return getattr(mod.InterpreterStatus, member)
-        elif "__set__" in obj:
-            return eval(obj["__set__"])
-        elif "__TopicMatch__" in obj:
-            return InfoManager.TopicMatch._init_from_decode(obj)
-        elif "__StackExchangeResponse__" in obj:
-            return Query.StackExchangeResponse(None, json=obj["__StackExchangeResponse__"])
-        elif "__LuisData__" in obj:
-            return LuisData(obj["__LuisData__"])
-        return obj
+        return codec.decode_hook(obj)
 
 
 def main():
@@ -1,12 +1,19 @@
 
+from urllib import parse
+
+import requests
 from projectoxford.luis import LuisClient
 
+import bot_requests_async
+import resilience
+
 
 _SUBSCRIPTION_KEY = '7814a9388ef14151981f2037000ea288'   # Alex Neuenkirk's subscription key.
 _APP_IDS = {
     'HelpBot': '3b58ccb7-4165-4af0-9759-b028c73ce4f9',  # Testing only.
     'Petricca': '8f688b1d-6c6a-4245-8ca5-ec7a9eaddb6b'  # Currently the best.
 }
+_luis = resilience.dependency('luis', timeout=(3.05, 5), hedge_percentile=resilience.HEDGE_PERCENTILE)
 
 
 class BotLuisClient(LuisClient):
@@ -34,6 +41,18 @@ class BotLuisClient(LuisClient):
         ]
         return ''.join(items)
 
+    def query_raw(self, text):
+        """Queries the LUIS app for text, with the luis dependency's timeout and retries."""
+        r = _luis.call(lambda: requests.get(self.url + parse.quote(text), timeout=_luis.timeout))
+        r.raise_for_status()
+        return r.json()
+
+    async def query_raw_async(self, text):
+        """A coroutine that does what query_raw() does."""
+        r = await _luis.call_async(lambda: bot_requests_async.fetch(self.url + parse.quote(text), _luis.timeout))
+        r.raise_for_status()
+        return await r.json()
+
 
 MODEL_ENTITY_SCHEMA = {
     'negators': 'Negator',
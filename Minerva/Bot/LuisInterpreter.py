@@ -1,3 +1,4 @@
+import asyncio
 import warnings
 import json
 import operator
@@ -14,6 +15,18 @@ import DialogueStrings
 import HelpBot
 import Query
 import LuisClient
+import resilience
+
+_stopwords = None
+
+def english_stopwords():
+    """Returns the frozenset of nltk's English stopwords, read once per process."""
+    global _stopwords
+    if _stopwords is None:
+        # NLTK package (stopwords) raises ResourceWarning.
+        warnings.simplefilter("ignore", ResourceWarning)
+        _stopwords = frozenset(stopwords.words('english'))
+    return _stopwords
 
 
 #region Enumerations
@@ -123,8 +136,8 @@ class BaseLuisInterpreter(AbstractLuisInterpreter):
         for your application.
         
         """
-        for attr_name in sorted(LuisClient.MODEL_ENTITY_SCHEMA):
-            print("{}: {}".format(attr_name, getattr(self.luis_data, attr_name)))
+        for entity in self.luis_data.entities:
+            print("{}: {}".format(entity['type'], entity['entity']))
         print()
 
     def _quick_parse(self, text):
@@ -297,10 +310,8 @@ class ApiProjectSystemLuisInterpreter(BaseLuisInterpreter):
         self._info = InfoManager.ProjectSystemInfoManager(project_system)
         self._agent = agent
 
-        # NLTK package (stopwords) raises ResourceWarning.
-        warnings.simplefilter("ignore", ResourceWarning)
         # Get all query words that are not also nltk.corpus.stopwords
-        self.filter_out = set(stopwords.words('english'))
+        self.filter_out = english_stopwords()
 
         self._handlers = {'Learn About Topic': LearnAboutTopicHandler,
                           'Solve Problem': SolveProblemHandler,
@@ -309,6 +320,24 @@ class ApiProjectSystemLuisInterpreter(BaseLuisInterpreter):
                           'Install Something': InstallSomethingHandler}
 
     def interpret(self, data):
+        intent_handler = self._intent_handler(data)
+
+        # Work the query.
+        while intent_handler.data['status'] is InterpreterStatus.Working:
+            intent_handler.run_process()
+        
+        # Return updated data.
+        return intent_handler.data
+
+    async def interpret_async(self, data):
+        """A coroutine that does what interpret() does."""
+        intent_handler = self._intent_handler(data)
+        while intent_handler.data['status'] is InterpreterStatus.Working:
+            await intent_handler.run_process_async()
+        return intent_handler.data
+
+    def _intent_handler(self, data):
+        """Returns the handler that works data's top intent."""
         self.data = data
         self.luis_data = data['luis_data']
 
@@ -317,13 +346,7 @@ class ApiProjectSystemLuisInterpreter(BaseLuisInterpreter):
         self.luis_data.load_words_of_interest(self.data['variables']['interests'])
         self._print_from_data()
         print(json.dumps(self.data['luis_data'], indent=3, sort_keys=True, cls=HelpBot.DataEncoder))
-
-        # Work the query.
-        while intent_handler.data['status'] is InterpreterStatus.Working:
-            intent_handler.run_process()
-        
-        # Return updated data.
-        return intent_handler.data
+        return intent_handler
 
     def _format_data(self, json):
         """Formats the raw json into a more easily accessible dictionary."""
@@ -360,9 +383,8 @@ class ApiProjectSystemLuisInterpreter(BaseLuisInterpreter):
 
     def _filter_stopwords(self, to_filter):
         """Removes stopwords from to_filter."""
-        filter_out = set(stopwords.words('english'))
         word_set = set(to_filter)
-        return word_set - filter_out
+        return word_set - english_stopwords()
 
     def _get_all_topic_matches(self, query):
         """Returns a dictionary of topic/score pairs."""
@@ -478,7 +500,25 @@ class ApiProjectSystemLuisInterpreter(BaseLuisInterpreter):
 
     def get_query_responses(self, query):
         """Returns a list of query responses."""
-        query.initiate()
+        try:
+            query.initiate()
+        except resilience.FAILURES:
+            # Answer at once rather than wait on an unhealthy StackExchange.
+            return {'next': Next.Failure, 'post': self._agent.apologize_unavailable('StackOverflow')}
+        ret = self._query_responses_or_retry(query)
+        return ret if ret is not None else self.get_query_responses(query)
+
+    async def get_query_responses_async(self, query):
+        """A coroutine that does what get_query_responses() does."""
+        try:
+            await query.initiate_async()
+        except resilience.FAILURES:
+            return {'next': Next.Failure, 'post': self._agent.apologize_unavailable('StackOverflow')}
+        ret = self._query_responses_or_retry(query)
+        return ret if ret is not None else await self.get_query_responses_async(query)
+
+    def _query_responses_or_retry(self, query):
+        """Returns the process's result for query's response, or None to send query again."""
         # Did we get any responses?
         if not query.response.result_count:
             popped = query.query_string.tagged.pop()
@@ -492,7 +532,7 @@ class ApiProjectSystemLuisInterpreter(BaseLuisInterpreter):
             # Try to find queries that at least have the popped tag in the body.
             #query.query_string.add_param('body', popped)
             pass
-        return self.get_query_responses(query)
+        return None
         
     def print_responses(self, response):
         """Prints all records in a query response."""
@@ -849,6 +889,33 @@ class DefaultHandler:
 
     def run_process(self):
         """Runs the current process."""
+        f_attr, args = self._current_process()
+        ret = getattr(self.obj, f_attr)(*args)
+        self._process_returned(ret)
+
+    async def run_process_async(self):
+        """A coroutine that runs the current process.
+
+        A process with a coroutine variant, named with an _async suffix,
+        is awaited; any other is called as run_process() calls it, on the
+        event loop's executor when its arguments hold compact StackExchange
+        results.
+
+        """
+        f_attr, args = self._current_process()
+        f_async = getattr(self.obj, f_attr + '_async', None)
+        if f_async is not None:
+            ret = await f_async(*args)
+        elif any(r.is_compact() for r in Query.results_in(args)):
+            # Reading a compact result's full fields fetches them, which
+            # would block the event loop.
+            ret = await asyncio.get_running_loop().run_in_executor(None, getattr(self.obj, f_attr), *args)
+        else:
+            ret = getattr(self.obj, f_attr)(*args)
+        self._process_returned(ret)
+
+    def _current_process(self):
+        """Returns the current process's function attribute and arguments."""
         print('\n')
         proc = self.procedures[self.data['variables']['proc_index']]
         f_attr, v_attr, needs_message = proc
@@ -857,7 +924,9 @@ class DefaultHandler:
         if needs_message:
             args.append(self.data['msg_text'])
         print('\n   '.join(["ARGS:"] + ["{}"] * len(args)).format(*args))
-        ret = getattr(self.obj, f_attr)(*args)
+        return f_attr, args
+
+    def _process_returned(self, ret):
         print("RETURNED:")
         print(json.dumps(ret, sort_keys=True, indent=3, cls=HelpBot.DataEncoder))
         self._handle_return(ret)
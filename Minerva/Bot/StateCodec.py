@@ -0,0 +1,223 @@
+"""A registry-based codec for conversation state.
+
+Types are registered with an explicit tag and a pair of functions that
+turn an instance into plain data and back.  An encoded instance is a
+single-key dict, {tag: plain_data}, so decoding is one dict lookup per
+object instead of a chain of checks.  Enum members are tagged with their
+class name, so every registered Enum type decodes to the right class.
+
+Two backends are available: 'json', which produces JSON text, and
+'msgpack', which produces a smaller binary form when the msgpack package
+is installed.  Msgpack output is base64 wrapped behind a '~m1:' marker so
+that it can be stored wherever text is expected, and loads() accepts the
+output of either backend.
+
+Decoding can also be lazy: loads() leaves the values of any keys named
+in its lazy argument in their plain form, and only decodes one when it
+is first read.  A value that is never read is encoded again verbatim.
+
+"""
+import ast
+import base64
+import json
+from enum import Enum
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_MSGPACK_MARKER = '~m1:'
+
+
+class Codec:
+
+    """Encodes and decodes registered types to and from text."""
+
+    def __init__(self, backend='json'):
+        self._encoders = {}     # type: (tag, encode)
+        self._decoders = {}     # tag: decode
+        self._enums = {}        # class name: Enum type
+        self.set_backend(backend)
+
+    def set_backend(self, backend):
+        """Selects 'json' or 'msgpack' for dumps."""
+        if backend not in ('json', 'msgpack'):
+            raise ValueError("Unknown codec backend: {}".format(backend))
+        if backend == 'msgpack' and msgpack is None:
+            raise ValueError("The msgpack backend requires the msgpack package.")
+        self.backend = backend
+
+    def register(self, type_, tag, encode, decode=None):
+        """Registers type_ under tag.
+
+        Encode turns an instance into plain data.  Decode turns that data
+        back into an instance; without it, the tagged dict is left as is.
+
+        """
+        self._encoders[type_] = (tag, encode)
+        if decode is not None:
+            self._decoders[tag] = decode
+
+    def register_enum(self, *enum_types):
+        """Registers each Enum type so that its members round trip."""
+        for enum_type in enum_types:
+            self._enums[enum_type.__name__] = enum_type
+
+    # Hooks, usable with the json and msgpack modules directly.
+    def default(self, obj):
+        """Returns the tagged plain form of obj, for json.dumps."""
+        if isinstance(obj, Deferred):
+            if not obj.is_resolved():
+                return obj.plain
+            obj = obj.resolve()
+            if not isinstance(obj, Enum) and not any(isinstance(obj, t) for t in self._encoders):
+                return obj
+        try:
+            tag, encode = self._encoders[type(obj)]
+        except KeyError:
+            if isinstance(obj, Enum) and type(obj).__name__ in self._enums:
+                return {'__enum__': '{}.{}'.format(type(obj).__name__, obj.name)}
+            for type_, (tag, encode) in self._encoders.items():
+                if isinstance(obj, type_):
+                    break
+            else:
+                raise TypeError("{!r} is not a registered state type.".format(type(obj)))
+        return {tag: encode(obj)}
+
+    def decode_hook(self, obj):
+        """Returns the instance for a tagged dict, for json.loads."""
+        if len(obj) != 1:
+            return obj
+        tag, value = next(iter(obj.items()))
+        if tag == '__enum__':
+            return self._decode_enum(value)
+        decode = self._decoders.get(tag)
+        if decode is None:
+            return obj
+        return decode(value)
+
+    def _decode_enum(self, value):
+        class_name, _, member = value.partition('.')
+        try:
+            return self._enums[class_name][member]
+        except KeyError:
+            raise ValueError("Unknown enum member in state: {}".format(value))
+
+    def decode(self, obj, lazy=()):
+        """Returns plain data with each tagged dict decoded, bottom up.
+
+        Values under any key in lazy are wrapped in a Deferred, and the
+        dict that holds them becomes a LazyDict.
+
+        """
+        lazy = frozenset(lazy)
+        return self._decode(obj, lazy)
+
+    def _decode(self, obj, lazy):
+        if type(obj) is list:
+            return [self._decode(item, lazy) if type(item) in (list, dict) else item for item in obj]
+        if type(obj) is not dict:
+            return obj
+        if lazy.isdisjoint(obj):
+            decoded = {key: self._decode(value, lazy) if type(value) in (list, dict) else value
+                       for key, value in obj.items()}
+            return self.decode_hook(decoded) if len(decoded) == 1 else decoded
+        return LazyDict((key, Deferred(self, value) if key in lazy else self._decode(value, lazy))
+                        for key, value in obj.items())
+
+    # Text.
+    def dumps(self, obj):
+        """Returns obj encoded with the current backend, as text."""
+        if self.backend == 'msgpack':
+            packed = msgpack.packb(obj, default=self.default, use_bin_type=True)
+            return _MSGPACK_MARKER + base64.b64encode(packed).decode('ascii')
+        return json.dumps(obj, default=self.default, separators=(',', ':'))
+
+    def loads(self, text, lazy=()):
+        """Returns the object encoded in text by either backend.
+
+        The values of any keys in lazy are decoded when they are first
+        read, see decode().
+
+        """
+        object_hook = None if lazy else self.decode_hook
+        if text.startswith(_MSGPACK_MARKER):
+            if msgpack is None:
+                raise ValueError("This state was saved with msgpack, which is not installed.")
+            packed = base64.b64decode(text[len(_MSGPACK_MARKER):])
+            obj = msgpack.unpackb(packed, object_hook=object_hook, raw=False)
+        else:
+            obj = json.loads(text, object_hook=object_hook)
+        return self.decode(obj, lazy) if lazy else obj
+
+
+class Deferred:
+
+    """A value left in its plain form until it is first resolved."""
+
+    def __init__(self, codec, plain):
+        self.codec = codec
+        self.plain = plain
+        self._resolved = False
+        self._value = None
+
+    def resolve(self):
+        """Returns the decoded value."""
+        if not self._resolved:
+            self._value = self.codec.decode(self.plain)
+            self._resolved = True
+        return self._value
+
+    def is_resolved(self):
+        """True once the value has been decoded."""
+        return self._resolved
+
+    def __repr__(self):
+        return "Deferred({!r})".format(self.plain)
+
+
+class LazyDict(dict):
+
+    """A dict that resolves its Deferred values as they are read.
+
+    Only item access, get() and pop() resolve.  Iterating over items() or
+    values() yields any unread Deferred as is, which the codec encodes
+    again without decoding it.
+
+    """
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, Deferred):
+            value = value.resolve()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+
+def encode_set(obj):
+    """Returns the plain form of a set, sorted when its items allow."""
+    try:
+        return sorted(obj)
+    except TypeError:
+        return list(obj)
+
+def decode_set(value):
+    """Returns the set for an encoded set.
+
+    State saved by older versions holds the set's repr instead of a list.
+
+    """
+    if isinstance(value, str):
+        return set() if value == 'set()' else set(ast.literal_eval(value))
+    return set(value)
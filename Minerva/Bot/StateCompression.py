@@ -0,0 +1,84 @@
+"""An optional compressed envelope for encoded conversation state.
+
+Encoded state at or above a size threshold is compressed and base64
+wrapped, behind a short versioned marker such as '~z1:'.  Encoded JSON
+always starts with '{', '[' or '"', so unpack can tell the two apart and
+state saved before compression was enabled still loads.
+
+"""
+import base64
+import lzma
+import os
+import zlib
+
+_VERSION = '1'
+
+# Marker letter: (compress, decompress).
+_ALGORITHMS = {
+    'z': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    'x': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+_NAMES = {'zlib': 'z', 'lzma': 'x'}
+
+# Defaults, which can be set by environment variable or by configure().
+ALGORITHM = os.environ.get('STATE_COMPRESSION', 'zlib').lower()
+try:
+    LEVEL = int(os.environ.get('STATE_COMPRESSION_LEVEL', '6'))
+    THRESHOLD = int(os.environ.get('STATE_COMPRESSION_THRESHOLD', '1024'))
+except ValueError:
+    LEVEL = 6
+    THRESHOLD = 1024
+
+
+def configure(algorithm=None, level=None, threshold=None):
+    """Changes the defaults used by pack.
+
+    Algorithm is 'zlib', 'lzma' or 'none'.  Level trades speed for ratio,
+    from 0 (or 1) to 9.  Threshold is the smallest text, in characters,
+    that is compressed.
+
+    """
+    global ALGORITHM, LEVEL, THRESHOLD
+    if algorithm is not None:
+        if algorithm != 'none' and algorithm not in _NAMES:
+            raise ValueError("Unknown compression algorithm: {}".format(algorithm))
+        ALGORITHM = algorithm
+    if level is not None:
+        LEVEL = level
+    if threshold is not None:
+        THRESHOLD = threshold
+
+
+def pack(text, algorithm=None, level=None, threshold=None):
+    """Returns text, compressed into an envelope if it is large enough.
+
+    The original text is returned when it is below the threshold,
+    compression is off, or the envelope would not be any smaller.
+
+    """
+    algorithm = algorithm or ALGORITHM
+    level = LEVEL if level is None else level
+    threshold = THRESHOLD if threshold is None else threshold
+    if algorithm == 'none' or len(text) < threshold:
+        return text
+
+    marker = _NAMES[algorithm]
+    compress, _ = _ALGORITHMS[marker]
+    body = base64.b64encode(compress(text.encode('utf-8'), level)).decode('ascii')
+    packed = ''.join(['~', marker, _VERSION, ':', body])
+    return packed if len(packed) < len(text) else text
+
+
+def unpack(text):
+    """Returns the original text of a packed envelope, or text itself."""
+    if not is_packed(text):
+        return text
+    _, decompress = _ALGORITHMS[text[1]]
+    body = text[text.index(':') + 1:]
+    return decompress(base64.b64decode(body)).decode('utf-8')
+
+
+def is_packed(text):
+    """True when text is a compressed envelope."""
+    return (isinstance(text, str) and len(text) > 4 and text[0] == '~'
+            and text[1] in _ALGORITHMS and text[2:4] == _VERSION + ':')
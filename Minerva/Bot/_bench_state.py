@@ -0,0 +1,220 @@
+"""Benchmarks the encoding of HelpBot conversation state.
+
+Run from the Bot directory, with the other Minerva directories on the
+path as in Library.pyproj:
+
+    python _bench_state.py [state.json ...]
+
+Each optional argument is a file holding the raw conversation state text
+of a real conversation (the 'data' of a conversation state GET).  Without
+arguments, representative payloads are built from the HelpBot types.
+
+"""
+import contextlib
+import functools
+import io
+import json
+import sys
+import timeit
+from enum import Enum
+
+import InfoManager
+import Query
+import HelpBot
+import StateCodec
+import StateCompression
+
+_REPEAT = 200
+# Link speed used to estimate transfer time, in bits per second.
+_LINK_BPS = 10 * 1000 * 1000
+
+
+def _luis_json(query):
+    entities = [
+        ('debugging', 'Jargon::Single Word'), ('remote debugging', 'Jargon::Phrase'),
+        ('breakpoints', 'Jargon::Debugging'), ('python', 'Subjects::Programming Language'),
+        ('azure', 'Subjects::Services'), ('django', 'Subjects::Framework'),
+        ('visual studio', 'Subjects::Installable'), ('how do i', 'Learn About Triggers::Phrase'),
+        ('set', 'Action::Conjugated Verb'), ('attaching', 'Action::Gerund'),
+        ('3 . 5', 'Auxiliary::Version'), ('web app', 'Subjects::Other'),
+    ]
+    return {
+        'query': query,
+        'intents': [{'intent': name, 'score': score} for name, score in
+                    [('Debugging Help', 0.91), ('Solve Problem', 0.42), ('Learn About Topic', 0.12),
+                     ('Install Something', 0.03), ('Get Opinion', 0.01), ('None', 0.01)]],
+        'entities': [{'entity': e, 'type': t, 'startIndex': i * 7, 'endIndex': i * 7 + len(e), 'score': 0.9}
+                     for i, (e, t) in enumerate(entities)],
+    }
+
+
+def _question_items(count, body_size):
+    body = '<p>' + ' '.join(['When I attach the remote debugger to my Django app on Azure '
+                             'the breakpoints are never hit.'] * (body_size // 90)) + '</p>'
+    return [{
+        'question_id': 30000000 + i,
+        'title': 'Remote debugging a Django web app on Azure with PTVS ({})'.format(i),
+        'link': 'https://stackoverflow.com/questions/{}/remote-debugging'.format(30000000 + i),
+        'answer_count': i % 4,
+        'is_answered': bool(i % 2),
+        'score': i,
+        'tags': ['python', 'django', 'azure', 'ptvs', 'remote-debugging'],
+        'owner': {'user_id': 1000 + i, 'display_name': 'user{}'.format(i), 'reputation': 10 * i},
+        'body': body,
+    } for i in range(count)]
+
+
+def _matches(*paths):
+    matches = []
+    for path in paths:
+        match = InfoManager.TopicMatch(path[-1], len(path) + 2)
+        match.path = list(path)
+        matches.append(match)
+    return matches
+
+
+def build_payloads():
+    """Returns a dict of name: state text for typical HelpBot turns."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        # LuisData prints each attribute as it is set.
+        luis_data = HelpBot.LuisData(_luis_json('How do I set breakpoints when remote debugging Django on Azure?'))
+    top_matches = _matches(['Debugging', 'Remote Debugging'], ['Environments'])
+    learn_about = {
+        'interpreter': {'status': HelpBot.LuisInterpreter.InterpreterStatus.WaitingToContinue,
+                        'msg_text': '2'},
+        'variables': {'interests': ['all_jargon', 'metas', 'services', 'frameworks', 'languages'],
+                      'top_count': 1, 'match_index': 0, 'proc_index': 4,
+                      'top_matches': top_matches, 'complete_matches': [],
+                      'incomplete_matches': top_matches,
+                      'options': ['Cross Platform Remote Debugging', 'Remote Debugging Microsoft Azure Web Sites']},
+        'luis_data': luis_data,
+    }
+
+    response = Query.StackExchangeResponse(None, json={'items': _question_items(30, 2000)})
+    for result in response.results:
+        result.combined_score = result.answer_count
+    solve_problem = dict(learn_about)
+    solve_problem['variables'] = dict(learn_about['variables'], query_response=response,
+                                      sorted_results=response.results[:5])
+
+    return {
+        'learn about (waiting)': json.dumps(learn_about, cls=HelpBot.DataEncoder),
+        'solve problem (results)': json.dumps(solve_problem, cls=HelpBot.DataEncoder),
+        'solve problem (full items)': json.dumps(dict(solve_problem, variables=dict(
+            solve_problem['variables'], query_response=response._json)), cls=HelpBot.DataEncoder),
+    }
+
+
+def _transfer_us(size):
+    return size * 8 / _LINK_BPS * 1e6
+
+
+def bench_compression(name, text):
+    """Prints the size and timings of each compression setting for text.
+
+    Total is the time to pack, send, receive and unpack the state once,
+    with the transfer time estimated at _LINK_BPS.
+
+    """
+    print("{} - {:,} characters".format(name, len(text)))
+    print("    {:<10}{:>10}{:>8}{:>12}{:>12}{:>12}".format('setting', 'bytes', 'ratio', 'pack us', 'unpack us', 'total us'))
+    print("    {:<10}{:>10,}{:>8.2f}{:>12}{:>12}{:>12.1f}".format('none', len(text), 1, '-', '-', 2 * _transfer_us(len(text))))
+    for algorithm, level in [('zlib', 1), ('zlib', 6), ('zlib', 9), ('lzma', 0), ('lzma', 6)]:
+        packed = StateCompression.pack(text, algorithm, level, threshold=0)
+        pack_us = timeit.timeit(lambda: StateCompression.pack(text, algorithm, level, threshold=0), number=_REPEAT) / _REPEAT * 1e6
+        unpack_us = timeit.timeit(lambda: StateCompression.unpack(packed), number=_REPEAT) / _REPEAT * 1e6
+        print("    {:<10}{:>10,}{:>8.2f}{:>12.1f}{:>12.1f}{:>12.1f}".format(
+            '{}-{}'.format(algorithm, level), len(packed), len(text) / len(packed),
+            pack_us, unpack_us, pack_us + unpack_us + 2 * _transfer_us(len(packed))))
+    print()
+
+
+class _LegacyEncoder(json.JSONEncoder):
+
+    """The isinstance chain and eval based hook used before StateCodec."""
+
+    def default(self, obj):
+        if isinstance(obj, Enum):
+            return {"__enum__": str(obj)}
+        elif isinstance(obj, set):
+            return {"__set__": str(obj)}
+        elif isinstance(obj, InfoManager.TopicMatch):
+            return {"__TopicMatch__": dict(obj)}
+        elif isinstance(obj, Query.StackExchangeResponse):
+            return {"__StackExchangeResponse__": obj.compact()}
+        elif isinstance(obj, Query.StackExchangeQuery):
+            return {"__StackExchangeQuery__": repr(obj)}
+        elif isinstance(obj, Query.QuestionResult):
+            return {"__QuestionResult__": obj.compact()}
+        elif isinstance(obj, HelpBot.LuisData):
+            return {"__LuisData__": obj.json_}
+        return json.JSONEncoder.default(self, obj)
+
+    @classmethod
+    def decode_hook(cls, obj):
+        if "__enum__" in obj:
+            name, member = obj["__enum__"].split('.')
+            return getattr(HelpBot.LuisInterpreter.InterpreterStatus, member)
+        elif "__set__" in obj:
+            return eval(obj["__set__"])
+        elif "__TopicMatch__" in obj:
+            return InfoManager.TopicMatch._init_from_decode(obj)
+        elif "__StackExchangeResponse__" in obj:
+            return Query.StackExchangeResponse.from_compact(obj["__StackExchangeResponse__"])
+        elif "__QuestionResult__" in obj:
+            return Query.QuestionResult.from_compact(obj["__QuestionResult__"])
+        elif "__LuisData__" in obj:
+            return HelpBot.LuisData(obj["__LuisData__"])
+        return obj
+
+
+def _codecs():
+    codecs = [('legacy', lambda obj: json.dumps(obj, cls=_LegacyEncoder),
+               lambda text: json.loads(text, object_hook=_LegacyEncoder.decode_hook))]
+    for backend in ('json', 'msgpack'):
+        if backend == 'msgpack' and StateCodec.msgpack is None:
+            continue
+        # Share the HelpBot registrations, with another backend.
+        codec = StateCodec.Codec(backend)
+        codec._encoders, codec._decoders, codec._enums = (
+            HelpBot.codec._encoders, HelpBot.codec._decoders, HelpBot.codec._enums)
+        codecs.append((backend, codec.dumps, codec.loads))
+        codecs.append((backend + '-lazy', codec.dumps,
+                       functools.partial(codec.loads, lazy=HelpBot.LAZY_KEYS)))
+    return codecs
+
+
+def bench_codecs(name, text):
+    """Prints the size and encode/decode timings of each codec for text."""
+    rows = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        # LuisData prints each attribute as it is decoded.
+        state = HelpBot.codec.loads(text)
+        for codec_name, dumps, loads in _codecs():
+            encoded = dumps(state)
+            encode_us = timeit.timeit(lambda: dumps(state), number=_REPEAT) / _REPEAT * 1e6
+            decode_us = timeit.timeit(lambda: loads(encoded), number=_REPEAT) / _REPEAT * 1e6
+            rows.append((codec_name, len(encoded), encode_us, decode_us))
+
+    print("{} - codecs".format(name))
+    print("    {:<14}{:>10}{:>12}{:>12}".format('codec', 'chars', 'encode us', 'decode us'))
+    for row in rows:
+        print("    {:<14}{:>10,}{:>12.1f}{:>12.1f}".format(*row))
+    print()
+
+
+def main(paths):
+    if paths:
+        payloads = {}
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                payloads[path] = StateCompression.unpack(f.read())
+    else:
+        payloads = build_payloads()
+
+    for name, text in payloads.items():
+        bench_codecs(name, text)
+        bench_compression(name, text)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,52 @@
+import unittest
+from HelpBot import LAZY_KEYS, VariableLog, codec
+
+class Test_VariableLog(unittest.TestCase):
+    def test_recordWithoutBase(self):
+        # Deltas whose base was never seen, as by another user of a group conversation.
+        log = VariableLog(None, {'base_version': 3, 'deltas': [{'set': {'proc_index': 1}}]})
+        self.assertIsNone(log.replay())
+        log.restart()
+        log.record({'proc_index': 0})
+        self.assertIsNotNone(log.base)
+        self.assertEqual(log.deltas(), {'base_version': 4, 'deltas': []})
+
+    def test_mismatchedReplayRestarts(self):
+        first = VariableLog()
+        first.record({'proc_index': 0})
+        stale = {'base_version': 7, 'deltas': [{'set': {'proc_index': 5}}]}
+
+        log = VariableLog(first.base, stale)
+        self.assertIsNone(log.replay())
+        log.restart()
+        log.record({'proc_index': 1})
+        self.assertEqual(log.deltas(), {'base_version': 8, 'deltas': []})
+
+        # The next turn replays the new base instead of failing again.
+        replayed = VariableLog(log.base, log.deltas()).replay()
+        self.assertEqual(replayed, {'proc_index': 1})
+
+    def test_replayAppliesDeltas(self):
+        log = VariableLog()
+        log.record({'proc_index': 0, 'interests': []})
+        log.replay()
+        log.record({'proc_index': 1})
+        replayed = VariableLog(log.base, log.deltas()).replay()
+        self.assertEqual(replayed, {'proc_index': 1})
+
+    def test_replayResolvesLazyDeltas(self):
+        # A large base, so that the change is kept as a delta.
+        interests = ['interest {}'.format(i) for i in range(50)]
+        log = VariableLog()
+        log.record({'proc_index': 0, 'interests': interests})
+        log.replay()
+        log.record({'proc_index': 1, 'interests': interests, 'top_matches': ['environments']})
+        self.assertEqual(len(log.deltas()['deltas']), 1)
+        # Saved and loaded with the conversation data, as by HelpBot.Conversation.
+        deltas = codec.loads(codec.dumps(log.deltas()), lazy=LAZY_KEYS)
+        replayed = VariableLog(log.base, deltas).replay()
+        self.assertEqual(replayed['top_matches'], ['environments'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""Benchmarks the server modes against many slow, I/O-bound requests.
+
+Run from the BotConnector directory:
+
+    python _bench_server.py [concurrency] [latency] [threads]
+
+Each mode serves, in a process of its own, an app that waits latency
+seconds per request as the bot waits on LUIS and StackExchange.
+concurrency clients then send requests at once, and the throughput,
+latencies and the server's peak memory, where /proc shows it, are
+reported.  The threaded server runs threads threads, and again one
+thread per client; the gevent server runs one greenlet per client.  The
+gevent row is skipped when gevent is not installed.
+
+"""
+import http.client
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_PORT = 3990
+_REQUESTS_PER_CLIENT = 10
+
+
+def _serve(mode, port, latency, size):
+    """Runs in the server process."""
+    if mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    import server
+
+    def app(environ, start_response):
+        time.sleep(latency)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    if mode == 'gevent':
+        server.run_gevent(app, 'localhost', port, size)
+    else:
+        server.run_threaded(app, 'localhost', port, size)
+
+
+def _get(port):
+    start = time.monotonic()
+    connection = http.client.HTTPConnection('localhost', port)
+    try:
+        connection.request('GET', '/')
+        connection.getresponse().read()
+    finally:
+        connection.close()
+    return time.monotonic() - start
+
+def _wait_for(port):
+    for _ in range(100):
+        try:
+            _get(port)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("The server did not start.")
+
+def _peak_rss_mb(pid):
+    """Returns the peak memory of process pid in MB, or '-' where /proc is not available."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return '-'
+
+def bench(mode, concurrency, latency, size):
+    process = subprocess.Popen(
+        [sys.executable, __file__, '--serve', mode, str(_PORT), str(latency), str(size)],
+        # The benchmark's output is the summary, not the request log.
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_for(_PORT)
+        count = concurrency * _REQUESTS_PER_CLIENT
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = sorted(executor.map(lambda _: _get(_PORT), range(count)))
+        elapsed = time.monotonic() - start
+        max_rss = _peak_rss_mb(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+    return (mode, size, count / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000, max_rss)
+
+
+def main(concurrency=200, latency=0.1, threads=16):
+    try:
+        import gevent
+    except ImportError:
+        gevent = None
+
+    print("{} clients, {}s per request".format(concurrency, latency))
+    print("    {:<10}{:>8}{:>12}{:>10}{:>10}{:>12}".format('mode', 'pool', 'req/s', 'p50 ms', 'p99 ms', 'max rss MB'))
+    rows = [bench('threaded', concurrency, latency, threads),
+            bench('threaded', concurrency, latency, concurrency)]
+    if gevent is not None:
+        rows.append(bench('gevent', concurrency, latency, concurrency))
+    for row in rows:
+        print("    {:<10}{:>8}{:>12.1f}{:>10.1f}{:>10.1f}{:>12}".format(*row))
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        mode, port, latency, size = sys.argv[2:]
+        _serve(mode, int(port), float(latency), int(size))
+    else:
+        args = sys.argv[1:]
+        main(*[f(a) for f, a in zip((int, float, int), args)])
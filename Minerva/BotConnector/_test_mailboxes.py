@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+import mailboxes
+from message import Message
+
+def _message(text, user_id='u'):
+    return Message({'type': 'message', 'timestamp': '', 'serviceUrl': 'http://localhost', 'channelId': 'emulator',
+                    'conversation': {'id': 'c'}, 'id': text, 'from': {'id': user_id}, 'recipient': {'id': 'bot'},
+                    'text': text})
+
+class Test_MailboxesOrdering(unittest.TestCase):
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertTrue(condition())
+
+    def test_turnsRunInArrivalOrderOneAtATime(self):
+        boxes = mailboxes.Mailboxes()
+        handled = []
+        running = []
+        overlaps = []
+        release = threading.Event()
+        def handle(i):
+            running.append(i)
+            overlaps.append(len(running))
+            if i == 0:
+                release.wait(5)
+            handled.append(i)
+            running.remove(i)
+            return i
+        results = {}
+        threads = []
+        for i in range(10):
+            thread = threading.Thread(target=lambda i=i: results.update({i: boxes.run('c', handle, i)}))
+            thread.start()
+            threads.append(thread)
+            # Each message arrives after the one before it.
+            self._wait_for(lambda: boxes.metrics()['waiting'] == i)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(handled, list(range(10)))
+        self.assertEqual(max(overlaps), 1)
+        self.assertEqual(results, {i: i for i in range(10)})
+        self.assertEqual(boxes.metrics()['conversations'], 0)
+
+    def test_conversationsRunInParallel(self):
+        boxes = mailboxes.Mailboxes()
+        busy = threading.Event()
+        release = threading.Event()
+        def block(item):
+            busy.set()
+            release.wait(5)
+        holder = threading.Thread(target=boxes.run, args=('c1', block, None))
+        holder.start()
+        busy.wait(5)
+        # Another conversation does not wait for c1.
+        self.assertEqual(boxes.run('c2', lambda item: item, 'done'), 'done')
+        release.set()
+        holder.join(5)
+
+class Test_MailboxesCoalescing(unittest.TestCase):
+    def _handle_behind_busy_turn(self, boxes, texts):
+        """Posts texts while the turn of an earlier message is being handled; returns what each turn saw."""
+        seen = []
+        busy = threading.Event()
+        release = threading.Event()
+        def handle(msg):
+            seen.append((msg.text, len(msg.absorbed)))
+            if msg.text == 'first':
+                busy.set()
+                release.wait(5)
+        holder = threading.Thread(target=boxes.post, args=('c', handle, _message('first')))
+        holder.start()
+        busy.wait(5)
+        for text in texts:
+            boxes.post('c', handle, _message(text))
+        release.set()
+        holder.join(5)
+        return seen
+
+    def test_mergesMessagesOfTheSameSender(self):
+        boxes = mailboxes.Mailboxes(merge=Message.absorb, sender=Message.sender_key)
+        seen = self._handle_behind_busy_turn(boxes, ['tell me', 'about environments'])
+        self.assertEqual(seen, [('first', 0), ('tell me about environments', 1)])
+
+    def test_replyToQuestionIsNotMerged(self):
+        # '2' picks an option the bot offered, so the follow-up is a turn of its own.
+        boxes = mailboxes.Mailboxes(merge=Message.absorb, sender=Message.sender_key,
+                                    hold=lambda msg: msg.text == '2')
+        seen = self._handle_behind_busy_turn(boxes, ['2', 'and virtualenv?'])
+        self.assertEqual(seen, [('first', 0), ('2', 0), ('and virtualenv?', 0)])
+        self.assertEqual(boxes.metrics()['coalesced'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from unittest import mock
+import bot_requests
+import state_store
+from message import Message
+
+def _activity(user_id):
+    return {'type': 'message', 'timestamp': '', 'serviceUrl': 'http://localhost', 'channelId': 'emulator',
+            'conversation': {'id': 'c'}, 'id': 'a', 'from': {'id': user_id}, 'recipient': {'id': 'bot'}}
+
+class _FailingSnapshotStore(state_store.MemoryStateStore):
+    def set(self, key, etag_and_data):
+        if key.scope == state_store.SNAPSHOT:
+            raise OSError("The snapshot could not be written.")
+        return state_store.MemoryStateStore.set(self, key, etag_and_data)
+
+class _FakeStateService:
+
+    """Stands in for the conversation data calls of bot_requests."""
+
+    def __init__(self):
+        self.records = {}
+        self.calls = []
+
+    def get_conversation_data(self, state_uri, channel_id, conversation_id, etag=None):
+        self.calls.append(('GET', conversation_id))
+        return self.records.get(conversation_id, {})
+
+    def set_conversation_data(self, state_uri, channel_id, conversation_id, etag_and_data):
+        self.calls.append(('POST', conversation_id))
+        etag = str(len(self.calls))
+        self.records[conversation_id] = {'data': etag_and_data['data'], 'eTag': etag}
+        return {'eTag': etag}
+
+class Test_MessageSnapshotData(unittest.TestCase):
+    def tearDown(self):
+        state_store.set_store(state_store.BotStateStore())
+
+    def test_sharedByConversation(self):
+        state_store.set_store(state_store.MemoryStateStore())
+        msg = Message(_activity('u1'))
+        msg.load_data(snapshot_data=True)
+        msg.snapshot_data['base'] = 'snapshot'
+        msg.save_data(include_snapshot_data=True)
+
+        other = Message(_activity('u2'))
+        other.load_data(snapshot_data=True)
+        self.assertEqual(other.snapshot_data, {'base': 'snapshot'})
+
+    def test_snapshotWrittenBeforeData(self):
+        store = _FailingSnapshotStore()
+        state_store.set_store(store)
+        msg = Message(_activity('u1'))
+        msg.load_data(snapshot_data=True)
+        with self.assertRaises(OSError):
+            with msg.state_session():
+                msg.snapshot_data['base'] = 'snapshot'
+                msg.data['deltas'] = ['delta']
+                msg.save_data(include_snapshot_data=True)
+        # The data that refers to the snapshot was not written either.
+        self.assertEqual(Message(_activity('u1')).data, {})
+
+    def test_stateServiceKeepsSnapshotInConversationData(self):
+        service = _FakeStateService()
+        state_store.set_store(state_store.BotStateStore())
+        with mock.patch.object(bot_requests, 'get_conversation_data', service.get_conversation_data), \
+             mock.patch.object(bot_requests, 'set_conversation_data', service.set_conversation_data):
+            msg = Message(_activity('u1'))
+            with msg.state_session():
+                msg.load_data(snapshot_data=True)
+                msg.snapshot_data['base'] = 'snapshot'
+                msg.data['deltas'] = ['delta']
+                msg.save_data(include_snapshot_data=True)
+            # One read and one write of the conversation's own record.
+            self.assertEqual(service.calls, [('GET', 'c'), ('POST', 'c')])
+
+            other = Message(_activity('u2'))
+            other.load_data(snapshot_data=True)
+            self.assertEqual(other.snapshot_data, {'base': 'snapshot'})
+            self.assertEqual(other.data, {'deltas': ['delta']})
+            self.assertEqual(service.calls[2:], [('GET', 'c')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import time
+import unittest
+import requests
+import resilience
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class Test_CircuitBreaker(unittest.TestCase):
+    def test_opensAfterThreshold(self):
+        breaker = resilience.CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        for _ in range(2):
+            breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, resilience.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_successResetsFailures(self):
+        breaker = resilience.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, resilience.CircuitBreaker.CLOSED)
+
+    def test_halfOpenTrial(self):
+        breaker = resilience.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        # A single trial call is let through.
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, resilience.CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        # Its failure reopens the circuit at once.
+        breaker.record_failure()
+        self.assertEqual(breaker.state, resilience.CircuitBreaker.OPEN)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, resilience.CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+class Test_Dependency(unittest.TestCase):
+    def _dependency(self, **settings):
+        settings.setdefault('breaker', resilience.CircuitBreaker(failure_threshold=2, reset_timeout=60))
+        settings.setdefault('budget', resilience.RetryBudget())
+        return resilience.Dependency('test', backoff=0, **settings)
+
+    def test_openCircuitFailsFast(self):
+        dependency = self._dependency(retries=0)
+        calls = []
+        def fail():
+            calls.append(1)
+            raise requests.ConnectionError("refused")
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                dependency.call(fail)
+        with self.assertRaises(resilience.CircuitOpenError):
+            dependency.call(fail)
+        self.assertEqual(len(calls), 2)
+
+    def test_failedResponsesAreRetriedAndClosed(self):
+        dependency = self._dependency(retries=2, breaker=resilience.CircuitBreaker(failure_threshold=10))
+        responses = [_Response(503), _Response(503), _Response(200)]
+        remaining = list(responses)
+        result = dependency.call(lambda: remaining.pop(0))
+        self.assertIs(result, responses[2])
+        self.assertEqual([r.closed for r in responses], [True, True, False])
+
+    def test_lastFailedResponseIsReturned(self):
+        dependency = self._dependency(retries=1, breaker=resilience.CircuitBreaker(failure_threshold=10))
+        responses = [_Response(503), _Response(503)]
+        remaining = list(responses)
+        result = dependency.call(lambda: remaining.pop(0))
+        self.assertIs(result, responses[1])
+        self.assertFalse(result.closed)
+
+    def test_retryBudgetLimitsRetries(self):
+        budget = resilience.RetryBudget(ratio=0, min_per_second=0, max_tokens=1)
+        dependency = self._dependency(retries=5, budget=budget,
+                                      breaker=resilience.CircuitBreaker(failure_threshold=10))
+        calls = []
+        def fail():
+            calls.append(1)
+            return _Response(503)
+        dependency.call(fail)
+        # The first attempt and the budget's single retry.
+        self.assertEqual(len(calls), 2)
+
+    def test_postIsNotRetriedAfterSending(self):
+        dependency = self._dependency(retries=2, breaker=resilience.CircuitBreaker(failure_threshold=10))
+        calls = []
+        def fail():
+            calls.append(1)
+            return _Response(503)
+        dependency.call(fail, idempotent=False)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
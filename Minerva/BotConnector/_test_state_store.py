@@ -0,0 +1,76 @@
+import time
+import unittest
+import state_store
+
+_KEY = state_store.conversation_key(None, 'emulator', 'c')
+
+class _CountingStore(state_store.MemoryStateStore):
+
+    """A memory store that records the eTag of each read and what it returned."""
+
+    def __init__(self):
+        state_store.MemoryStateStore.__init__(self)
+        self.reads = []
+
+    def get(self, key, etag=None):
+        state = state_store.MemoryStateStore.get(self, key, etag)
+        self.reads.append((etag, state is None))
+        return state
+
+class Test_CachingStateStore(unittest.TestCase):
+    def setUp(self):
+        self.backing = _CountingStore()
+        self.store = state_store.CachingStateStore(self.backing, ttl=60)
+
+    def test_unchangedStateIsNotTransferred(self):
+        self.store.set(_KEY, {'data': {'turn': 1}, 'eTag': '*'})
+        state = self.store.get(_KEY)
+        self.assertEqual(state['data'], {'turn': 1})
+        # Asked for changes since the cached eTag, and answered not modified.
+        self.assertEqual(self.backing.reads, [(state['eTag'], True)])
+        self.assertEqual((self.store.hits, self.store.misses), (1, 0))
+
+    def test_callerEtagStillMatches(self):
+        etag = self.store.set(_KEY, {'data': {'turn': 1}, 'eTag': '*'})['eTag']
+        self.assertIsNone(self.store.get(_KEY, etag))
+
+    def test_cachedCopyIsNotShared(self):
+        self.store.set(_KEY, {'data': {'turn': 1}, 'eTag': '*'})
+        self.store.get(_KEY)['data']['turn'] = 2
+        self.assertEqual(self.store.get(_KEY)['data'], {'turn': 1})
+
+    def test_changeByAnotherWriterIsSeen(self):
+        self.store.set(_KEY, {'data': {'turn': 1}, 'eTag': '*'})
+        # Another process writes through its own cache.
+        self.backing.set(_KEY, {'data': {'turn': 2}, 'eTag': '*'})
+        state = self.store.get(_KEY)
+        self.assertEqual(state['data'], {'turn': 2})
+        self.assertEqual(self.store.misses, 1)
+        # The new state is cached in turn.
+        self.assertEqual(self.store.get(_KEY)['data'], {'turn': 2})
+        self.assertEqual(self.store.hits, 1)
+
+    def test_staleWriteIsRejected(self):
+        etag = self.store.set(_KEY, {'data': {'turn': 1}, 'eTag': '*'})['eTag']
+        self.backing.set(_KEY, {'data': {'turn': 2}, 'eTag': etag})
+        with self.assertRaises(state_store.StateConflictError):
+            self.store.set(_KEY, {'data': {'turn': 3}, 'eTag': etag})
+        # The failed write is not cached.
+        self.assertEqual(self.store.get(_KEY)['data'], {'turn': 2})
+
+    def test_expiredEntryIsReadInFull(self):
+        store = state_store.CachingStateStore(self.backing, ttl=0.01)
+        store.set(_KEY, {'data': {'turn': 1}, 'eTag': '*'})
+        time.sleep(0.02)
+        self.assertEqual(store.get(_KEY)['data'], {'turn': 1})
+        self.assertEqual(self.backing.reads, [(None, False)])
+
+    def test_userScopeIsNotCached(self):
+        key = state_store.user_key(None, 'emulator', 'u')
+        self.store.set(key, {'data': {'name': 'u'}, 'eTag': '*'})
+        self.store.get(key)
+        self.assertEqual(self.backing.reads, [(None, False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
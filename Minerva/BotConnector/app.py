@@ -1,7 +1,23 @@
 import os
 import sys
 import argparse
-from bottle import get, post, request
+
+def _gevent_requested():
+    args = sys.argv[1:]
+    if '--server=gevent' in args:
+        return True
+    if '--server' in args:
+        i = args.index('--server')
+        return args[i + 1:i + 2] == ['gevent']
+    return os.environ.get('SERVER_MODE', '').lower() == 'gevent'
+
+if __name__ == '__main__' and _gevent_requested():
+    # The standard library must be patched before anything imports it,
+    # so that sockets, locks and sleeps yield to other greenlets.
+    from gevent import monkey
+    monkey.patch_all()
+
+from bottle import get, post, request, response
 
 if '--debug' in sys.argv[1:] or 'SERVER_DEBUG' in os.environ:
     # Debug mode will enable more verbose output in the console window.
@@ -11,9 +27,121 @@ if '--debug' in sys.argv[1:] or 'SERVER_DEBUG' in os.environ:
 
 from message import Message
 import HelpBot as bot
+import dispatch
+import idempotency
+import mailboxes
+import resilience
+import server
+import state_store
 
 PROJECT_SYSTEM = 'PTVS'
 
+# Where conversation state is kept, see state_store.from_config.
+STATE_STORE = os.environ.get('STATE_STORE', 'botstate')
+# Seconds that conversation state is cached locally between turns, 0 to disable.
+try:
+    STATE_CACHE_TTL = float(os.environ.get('STATE_CACHE_TTL', '300'))
+except ValueError:
+    STATE_CACHE_TTL = 300
+state_store.set_store(state_store.from_config(STATE_STORE, STATE_CACHE_TTL))
+
+# When set, messages are acknowledged with 202 and handled by background
+# workers, see dispatch.Dispatcher.
+ASYNC_DISPATCH = os.environ.get('ASYNC_DISPATCH', '').lower() in ('1', 'true', 'yes')
+try:
+    DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '4'))
+    DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', '100'))
+except ValueError:
+    DISPATCH_WORKERS = 4
+    DISPATCH_QUEUE_SIZE = 100
+dispatcher = None
+
+# Activities in flight or handled recently, so that redeliveries are not
+# handled again.  Seconds they are remembered, and how long a redelivery
+# waits for the first delivery to finish.
+try:
+    ACTIVITY_CACHE_TTL = float(os.environ.get('ACTIVITY_CACHE_TTL', '300'))
+    DUPLICATE_WAIT = float(os.environ.get('DUPLICATE_WAIT', '30'))
+except ValueError:
+    ACTIVITY_CACHE_TTL = 300
+    DUPLICATE_WAIT = 30
+activities = idempotency.ActivityCache(ACTIVITY_CACHE_TTL)
+
+# When set, a typing indicator is sent as soon as a message is accepted.
+SEND_TYPING = os.environ.get('SEND_TYPING', '1').lower() not in ('0', 'false', 'no')
+
+# Each conversation's messages are handled one at a time, in order.  When
+# COALESCE_MESSAGES is set, messages waiting for their turn are merged
+# into the one ahead of them if the same user sent both, unless that one
+# answers the bot's question; the turn first waits until nothing has been
+# sent for COALESCE_WINDOW seconds.
+COALESCE_MESSAGES = os.environ.get('COALESCE_MESSAGES', '').lower() in ('1', 'true', 'yes')
+try:
+    COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', '0'))
+except ValueError:
+    COALESCE_WINDOW = 0.0
+conversations = mailboxes.Mailboxes(merge=Message.absorb if COALESCE_MESSAGES else None, window=COALESCE_WINDOW,
+                                    sender=Message.sender_key, hold=bot.awaits_reply)
+
+def _handle_message(msg):
+    return bot.on_message(msg, PROJECT_SYSTEM)
+
+def _handle_queued_message(msg):
+    """Hands a message accepted by root() to its conversation's mailbox."""
+    conversations.post(msg.conversation_key(), _handle_and_record, msg)
+
+def _handle_and_record(msg):
+    """Handles a queued message and records its result, and that of the messages it absorbed."""
+    keys = [m.activity_key() for m in [msg] + msg.absorbed]
+    try:
+        result = _handle_message(msg)
+    except Exception:
+        for key in keys:
+            activities.end(key, failed=True)
+        raise
+    for key in keys:
+        activities.end(key, result)
+
+def start_dispatcher():
+    """Starts the background workers that handle messages."""
+    global dispatcher
+    if dispatcher is None:
+        dispatcher = dispatch.Dispatcher(_handle_queued_message, DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE)
+        dispatcher.start()
+
+if ASYNC_DISPATCH:
+    start_dispatcher()
+
+# How __main__ serves the app: wsgiref (one request at a time), threaded
+# (a pool of SERVER_THREADS threads), prefork (SERVER_WORKERS processes
+# of SERVER_THREADS threads each) or gevent (up to SERVER_GREENLETS
+# greenlets), see server.py.
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threaded').lower()
+try:
+    SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', str(os.cpu_count() or 1)))
+    SERVER_THREADS = int(os.environ.get('SERVER_THREADS', '16'))
+    SERVER_GREENLETS = int(os.environ.get('SERVER_GREENLETS', '1000'))
+except ValueError:
+    SERVER_WORKERS = os.cpu_count() or 1
+    SERVER_THREADS = 16
+    SERVER_GREENLETS = 1000
+
+def preload():
+    """Loads the bot's read-only data before the server forks its workers."""
+    bot.preload(PROJECT_SYSTEM)
+
+def post_fork():
+    """Restarts, in a forked worker, the dispatcher threads that did not survive the fork."""
+    global dispatcher
+    if dispatcher is not None:
+        dispatcher = None
+        start_dispatcher()
+
+def on_exit():
+    """Lets the dispatcher finish the messages it has accepted."""
+    if dispatcher is not None:
+        dispatcher.stop()
+
 @get('/')
 def home():
     try:
@@ -26,15 +154,54 @@ def home():
     return "TODO: home page"
 
 
+@get('/api/metrics')
+def metrics():
+    if dispatcher is None:
+        stats = {'dispatch': 'synchronous'}
+    else:
+        stats = dict(dispatcher.metrics(), dispatch='background')
+    stats['conversations'] = conversations.metrics()
+    stats['activities'] = len(activities)
+    stats['duplicates'] = activities.duplicates
+    stats['circuits'] = resilience.states()
+    stats['hedges'] = resilience.hedge_counts()
+    return stats
+
+
 @post('/api/messages')
 def root():
-    msg = Message(request.json)
+    try:
+        msg = Message(request.json)
+    except (KeyError, TypeError):
+        response.status = 400
+        return {"message": "Not a valid activity."}
 
     if msg.type.lower() == 'ping':
         return
 
     if msg.type.lower() == 'message':
-        return bot.on_message(msg, PROJECT_SYSTEM)
+        if dispatcher is None:
+            def handle():
+                if SEND_TYPING:
+                    msg.send_typing()
+                return conversations.run(msg.conversation_key(), _handle_message, msg)
+            # A redelivery waits for, and answers with, the first delivery's result.
+            return activities.run(msg.activity_key(), handle, DUPLICATE_WAIT)
+        if not activities.begin(msg.activity_key()):
+            # Already queued or handled.
+            response.status = 202
+            return
+        try:
+            dispatcher.submit(msg)
+        except dispatch.QueueFullError:
+            activities.end(msg.activity_key(), failed=True)
+            response.status = 503
+            response.set_header('Retry-After', '1')
+            return {"message": "Too many messages, try again shortly."}
+        if SEND_TYPING:
+            msg.send_typing()
+        response.status = 202
+        return
 
     try:
         handler = getattr(bot, msg.type)
@@ -47,12 +214,33 @@ def root():
 
 def parse_cmd_args():
     # Handle command line args.
-    global PROJECT_SYSTEM
+    global PROJECT_SYSTEM, SERVER_MODE, SERVER_WORKERS, SERVER_THREADS, SERVER_GREENLETS
     parser = argparse.ArgumentParser()
     parser.add_argument("--proj_sys", "--project_system", help="The project system whose information is to be used.")
+    parser.add_argument("--state_store", help="Where to keep bot state: botstate, memory, sqlite:///<path> or redis://<host>:<port>.")
+    parser.add_argument("--async_dispatch", action="store_true", help="Acknowledge messages at once and handle them on background workers.")
+    parser.add_argument("--coalesce_window", type=float, help="Seconds of quiet to wait for more of a user's messages before handling them as one.")
+    parser.add_argument("--server", choices=('wsgiref', 'threaded', 'prefork', 'gevent'), help="How to serve requests: one at a time, on a pool of threads, from several processes, or on greenlets.")
+    parser.add_argument("--workers", type=int, help="The number of processes the prefork server runs.")
+    parser.add_argument("--threads", type=int, help="The number of threads each server process runs.")
+    parser.add_argument("--greenlets", type=int, help="The most requests the gevent server handles at once.")
     args = parser.parse_args()
     if args.proj_sys:
         PROJECT_SYSTEM = args.proj_sys.upper()
+    if args.state_store:
+        state_store.set_store(state_store.from_config(args.state_store, STATE_CACHE_TTL))
+    if args.async_dispatch:
+        start_dispatcher()
+    if args.coalesce_window is not None:
+        conversations.window = args.coalesce_window
+    if args.server:
+        SERVER_MODE = args.server
+    if args.workers:
+        SERVER_WORKERS = args.workers
+    if args.threads:
+        SERVER_THREADS = args.threads
+    if args.greenlets:
+        SERVER_GREENLETS = args.greenlets
 
 if __name__ == '__main__':
     import bottle
@@ -67,7 +255,17 @@ if __name__ == '__main__':
         PORT = int(os.environ.get('SERVER_PORT', '3978'))
     except ValueError:
         PORT = 3978
-    bottle.run(server='wsgiref', host=HOST, port=PORT)
+    if SERVER_MODE == 'prefork':
+        server.run_prefork(bottle.default_app(), HOST, PORT, SERVER_WORKERS, SERVER_THREADS,
+                           preload=preload, post_fork=post_fork, on_exit=on_exit)
+    elif SERVER_MODE == 'gevent':
+        server.run_gevent(bottle.default_app(), HOST, PORT, SERVER_GREENLETS,
+                          preload=preload, on_exit=on_exit)
+    elif SERVER_MODE == 'threaded':
+        server.run_threaded(bottle.default_app(), HOST, PORT, SERVER_THREADS,
+                            preload=preload, on_exit=on_exit)
+    else:
+        bottle.run(server='wsgiref', host=HOST, port=PORT)
 
     
 
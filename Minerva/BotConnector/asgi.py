@@ -0,0 +1,131 @@
+"""An ASGI entry point for the bot, with an asyncio message pipeline.
+
+Serve it with any ASGI server, from the BotConnector directory:
+
+    uvicorn asgi:application --port 3978
+
+Messages are handled by HelpBot.on_message_async, which waits on LUIS,
+StackExchange, the state store and the connector without holding a
+thread, so one event loop serves many conversations at once.  The
+settings, state store, activity cache and conversation mailboxes are
+those of app.py, whose bottle app remains the synchronous entry point.
+
+A redelivered activity is answered with 202 at once rather than waiting
+for its first delivery, since waiting would hold the event loop.  The
+typing indicator is sent by a task of its own, and the home page and
+activities other than messages are handled on the default executor.
+
+"""
+import asyncio
+import json
+import traceback
+
+import app as settings
+import bot_requests_async
+import HelpBot as bot
+from message import Message
+
+# Tasks sent on their own, kept until done so they are not collected.
+_background_tasks = set()
+
+
+async def application(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    elif scope['type'] == 'http':
+        await _http(scope, receive, send)
+
+
+async def _lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            settings.preload()
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await bot_requests_async.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def _http(scope, receive, send):
+    method, path = scope['method'], scope['path']
+    if method == 'POST' and path == '/api/messages':
+        status, body = await messages(await _read_body(receive))
+    elif method == 'GET' and path == '/api/metrics':
+        status, body = 200, settings.metrics()
+    elif method == 'GET' and path == '/':
+        status, body = 200, await asyncio.get_running_loop().run_in_executor(None, settings.home)
+    else:
+        status, body = 404, {"message": "Not found."}
+    await _respond(send, status, body)
+
+async def messages(body):
+    """Handles a POST to /api/messages and returns (status, response body)."""
+    try:
+        msg = Message(json.loads(body.decode('utf-8')))
+    except (KeyError, TypeError, ValueError):
+        return 400, {"message": "Not a valid activity."}
+
+    if msg.type.lower() == 'ping':
+        return 200, None
+
+    if msg.type.lower() == 'message':
+        key = msg.activity_key()
+        if not settings.activities.begin(key):
+            # Already in flight or handled.
+            return 202, None
+        if settings.SEND_TYPING:
+            _in_background(msg.send_typing_async())
+        try:
+            result = await settings.conversations.run_async(msg.conversation_key(), _handle_message, msg)
+        except Exception:
+            settings.activities.end(key, failed=True)
+            raise
+        settings.activities.end(key, result)
+        return 200, result
+
+    try:
+        handler = getattr(bot, msg.type)
+    except AttributeError:
+        return 200, {"message": "TODO: " + msg.type}
+    # Other activities are handled by the synchronous bot, off the event loop.
+    return 200, await asyncio.get_running_loop().run_in_executor(None, handler, msg)
+
+
+async def _handle_message(msg):
+    return await bot.on_message_async(msg, settings.PROJECT_SYSTEM)
+
+def _in_background(coroutine):
+    """Runs coroutine as a task of its own, printing any exception it raises."""
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+
+def _background_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        traceback.print_exception(type(task.exception()), task.exception(), task.exception().__traceback__)
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        event = await receive()
+        chunks.append(event.get('body', b''))
+        if not event.get('more_body'):
+            return b''.join(chunks)
+
+async def _respond(send, status, body):
+    if body is None:
+        content, content_type = b'', b'text/html; charset=UTF-8'
+    elif isinstance(body, str):
+        content, content_type = body.encode('utf-8'), b'text/html; charset=UTF-8'
+    else:
+        content, content_type = json.dumps(body).encode('utf-8'), b'application/json'
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(content)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': content})
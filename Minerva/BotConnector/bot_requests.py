@@ -1,50 +1,139 @@
+import contextlib
 import json
 from base64 import b64encode
 import requests
 import os
+import threading
+import traceback
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+import resilience
+import token_cache
+
 _AUTH_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
 _AUTH_SCOPE = 'https://graph.microsoft.com/.default'
 APP_ID = os.getenv('APP_ID')
 APP_PASSWORD = os.getenv('APP_PASSWORD')
+# The file that worker processes share their token through, in a directory
+# only this user can write to.  Unset, each process fetches its own token.
+TOKEN_CACHE = os.getenv('TOKEN_CACHE')
+# The most state requests a single call to fetch_concurrently will have in flight.
+_MAX_CONCURRENT_FETCHES = 6
+# The most calls made at once by send_in_background.
+_MAX_BACKGROUND_SENDS = 4
+# How long before its expiry a token is refreshed in the background.
+_REFRESH_MARGIN = timedelta(minutes=5)
+# Bytes read at a time when streaming attachments, a multiple of 3 so that
+# each chunk's base64 needs no padding.
+_STREAM_CHUNK_SIZE = 3 * 64 * 1024
+# Seconds to wait for a connection, and then for a response, from the connector.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+_bot_framework = resilience.dependency('botframework', timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+
+class _TimeoutSession(requests.Session):
+
+    """A requests session that applies the module's timeouts by default."""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+        return requests.Session.request(self, method, url, **kwargs)
 
 class _BotSession:
-    def __init__(self, auth_url, auth_scope, app_id, app_password):
+
+    """A pooled requests session whose token is refreshed before it expires.
+
+    The session is created once and kept, so its keep-alive connections
+    survive a refresh; only its Authorization header is swapped.  Within
+    _REFRESH_MARGIN of expiry, the first caller starts a single background
+    refresh and keeps using the current token.  Once the token has expired,
+    one caller refreshes while the others wait for its result.  Tokens are
+    fetched outside the lock that callers take, which only guards the swap,
+    so a caller whose token is still valid never waits on a refresh.
+
+    When given a token_cache.FileTokenCache, tokens are shared with the
+    other worker processes, so a new process starts with the cached token
+    and only one process at a time asks for a new one.
+
+    """
+
+    def __init__(self, auth_url, auth_scope, app_id, app_password, cache=None):
         self.auth_url = auth_url
         self.auth_scope = auth_scope
         self.app_id = app_id
         self.app_password = app_password
         
-        self._session = None
+        self._session = _TimeoutSession()
         self._token = None
         self._token_expires_at = datetime.utcnow()
-
-    def _refresh_token(self):
+        # Guards the token and _refreshing, and is never held during a request.
+        self._lock = threading.Lock()
+        # Held by the thread fetching a token, so only one fetches at a time.
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        self._cache = cache
+
+    def needs_refresh(self):
+        """True when get() would block to fetch a token."""
+        return self._token is None or self._token_expires_at <= datetime.utcnow()
+
+    def _fetch_token(self):
         r = requests.post(self.auth_url, data={
             'grant_type': 'client_credentials',
             'client_id': self.app_id,
             'client_secret': self.app_password,
             'scope': self.auth_scope,
-        })
-        self._token = _raise_or_get_json(r)
-        self._token_expires_at = datetime.utcnow() + timedelta(seconds=int(self._token.get('expires_in', 3600)))
+        }, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        token = _raise_or_get_json(r)
+        return token, int(token.get('expires_in', 3600))
+
+    def _refresh_token(self, margin=timedelta(0)):
+        if self._cache is None:
+            token, expires_in = self._fetch_token()
+            expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
+        else:
+            token, expires_at = self._cache.get_or_refresh(self._fetch_token, margin.total_seconds())
+            expires_at = datetime.utcfromtimestamp(expires_at)
+        with self._lock:
+            self._session.headers['Authorization'] = '{0[token_type]} {0[access_token]}'.format(token)
+            self._token = token
+            self._token_expires_at = expires_at
+
+    def _refresh_in_background(self):
+        try:
+            with self._refresh_lock:
+                if self._token_expires_at - datetime.utcnow() < _REFRESH_MARGIN:
+                    self._refresh_token(_REFRESH_MARGIN)
+        except Exception:
+            # The current token is still valid; the next call will retry.
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._refreshing = False
 
     def get(self):
-        if self._token_expires_at < datetime.utcnow():
-            if self._session:
-                self._session.close()
-                self._session = None
-            self._refresh_token()
-        if not self._session:
-            self._session = requests.Session()
-            self._session.headers['Authorization'] = '{0[token_type]} {0[access_token]}'.format(self._token)
+        remaining = self._token_expires_at - datetime.utcnow()
+        if self._token is None or remaining <= timedelta(0):
+            with self._refresh_lock:
+                # Another thread may have refreshed while this one waited.
+                if self._token is None or self._token_expires_at <= datetime.utcnow():
+                    self._refresh_token()
+        elif remaining < _REFRESH_MARGIN and not self._refreshing:
+            with self._lock:
+                start = not self._refreshing
+                self._refreshing = True
+            if start:
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
         return self._session
 
 class _EmulatorSession:
     def __init__(self):
-        self._session = requests.Session()
+        self._session = _TimeoutSession()
+
+    def needs_refresh(self):
+        return False
 
     def get(self):
         return self._session
@@ -52,11 +141,35 @@ class _EmulatorSession:
 if not APP_ID:
     _session = _EmulatorSession()
 else:
-    _session = _BotSession(_AUTH_URL, _AUTH_SCOPE, APP_ID, APP_PASSWORD)
+    if TOKEN_CACHE and TOKEN_CACHE.lower() != 'none':
+        _token_cache = token_cache.FileTokenCache(TOKEN_CACHE)
+    else:
+        _token_cache = None
+    _session = _BotSession(_AUTH_URL, _AUTH_SCOPE, APP_ID, APP_PASSWORD, _token_cache)
 
 def _join(*parts):
     return '/'.join(p.rstrip('/') for p in parts)
 
+def _request(method, url, retry=True, **kwargs):
+    """Makes a call through the Bot Framework dependency's retries and circuit breaker."""
+    kwargs.setdefault('timeout', _bot_framework.timeout)
+    return _bot_framework.call(
+        lambda: _session.get().request(method, url, **kwargs),
+        idempotent=method in ('GET', 'DELETE'), retry=retry,
+    )
+
+def _error_from_json(data):
+    """Returns the exception for an error response's json, or None if it has no message.
+
+    Shared with bot_requests_async, so both raise the same errors.
+
+    """
+    if isinstance(data, dict) and 'message' in data:
+        # Chain the exception with more specific info
+        # TODO: Better exception type here
+        return Exception(data['message'])
+    return None
+
 def _raise_or_get_json(response):
     if response.status_code == 403:
         print(response.request.headers)
@@ -70,10 +183,9 @@ def _raise_or_get_json(response):
         except Exception:
             pass
         else:
-            if 'message' in data:
-                # Chain the exception with more specific info
-                # TODO: Better exception type here
-                raise Exception(data['message'])
+            error = _error_from_json(data)
+            if error is not None:
+                raise error
             raise
     try:
         return response.json()
@@ -82,70 +194,122 @@ def _raise_or_get_json(response):
 
 #region BotState API
 
+def _state_headers(etag):
+    """Returns the headers for a state GET, conditional when etag is given."""
+    headers = {'Accept': 'application/json'}
+    if etag and etag != '*':
+        headers['If-None-Match'] = etag
+    return headers
+
+def _raise_or_get_state(response):
+    """Returns the state in response, or None when it was not modified."""
+    if response.status_code == 304:
+        return None
+    return _raise_or_get_json(response)
+
 def delete_state_for_user(state_uri, channel_id, user_id):
-    r = _session.get().delete(
+    r = _request('DELETE',
         _join(state_uri, 'v3', 'botstate', channel_id, 'users', user_id),
     )
     _raise_or_get_json(r)
 
-def get_user_data(state_uri, channel_id, user_id):
-    r = _session.get().get(
+def get_user_data(state_uri, channel_id, user_id, etag=None):
+    r = _request('GET',
         _join(state_uri, 'v3', 'botstate', channel_id, 'users', user_id),
-        headers={'Accept': 'application/json'},
+        headers=_state_headers(etag),
     )
-    return _raise_or_get_json(r)
+    return _raise_or_get_state(r)
 
 def set_user_data(state_uri, channel_id, user_id, etag_and_data):
-    r = _session.get().post(
+    r = _request('POST',
         _join(state_uri, 'v3', 'botstate', channel_id, 'users', user_id),
         json=etag_and_data,
         headers={'Accept': 'application/json'},
     )
     return _raise_or_get_json(r)
 
-def get_conversation_data(state_uri, channel_id, conversation_id):
-    r = _session.get().get(
+def get_conversation_data(state_uri, channel_id, conversation_id, etag=None):
+    r = _request('GET',
         _join(state_uri, 'v3', 'botstate', channel_id, 'conversations', conversation_id),
-        headers={'Accept': 'application/json'},
+        headers=_state_headers(etag),
     )
-    return _raise_or_get_json(r)
+    return _raise_or_get_state(r)
 
 def set_conversation_data(state_uri, channel_id, conversation_id, etag_and_data):
-    r = _session.get().post(
+    r = _request('POST',
         _join(state_uri, 'v3', 'botstate', channel_id, 'conversations', conversation_id),
         json=etag_and_data,
         headers={'Accept': 'application/json'},
     )
     return _raise_or_get_json(r)
 
-def get_private_conversation_data(state_uri, channel_id, conversation_id, user_id):
-    r = _session.get().get(
+def get_private_conversation_data(state_uri, channel_id, conversation_id, user_id, etag=None):
+    r = _request('GET',
         _join(state_uri, 'v3', 'botstate', channel_id, 'conversations', conversation_id, 'users', user_id),
-        headers={'Accept': 'application/json'},
+        headers=_state_headers(etag),
     )
-    return _raise_or_get_json(r)
+    return _raise_or_get_state(r)
 
 def set_private_conversation_data(state_uri, channel_id, conversation_id, user_id, etag_and_data):
-    r = _session.get().post(
+    r = _request('POST',
         _join(state_uri, 'v3', 'botstate', channel_id, 'conversations', conversation_id, 'users', user_id),
         json=etag_and_data,
         headers={'Accept': 'application/json'},
     )
     return _raise_or_get_json(r)
 
+def fetch_concurrently(calls):
+    """Runs each (function, args) pair in calls at the same time.
+
+    Returns the results in the same order as calls.  The first call is
+    made on the calling thread, and the others on threads of this call's
+    own, so one turn's fetches never wait behind another's; a single call
+    starts no thread at all.  The first exception raised by any call is
+    re-raised after all calls have finished.
+
+    """
+    if len(calls) <= 1:
+        return [f(*args) for f, args in calls]
+    (first_f, first_args), rest = calls[0], calls[1:]
+    first = Future()
+    with ThreadPoolExecutor(max_workers=min(len(rest), _MAX_CONCURRENT_FETCHES - 1)) as executor:
+        futures = [executor.submit(f, *args) for f, args in rest]
+        try:
+            first.set_result(first_f(*first_args))
+        except Exception as e:
+            first.set_exception(e)
+    # Leaving the with block waited for the other calls.
+    return [future.result() for future in [first] + futures]
+
+_background_executor = ThreadPoolExecutor(max_workers=_MAX_BACKGROUND_SENDS)
+
+def send_in_background(f, *args):
+    """Calls f(*args) on a background thread and returns its future.
+
+    For calls whose result the caller does not wait for, such as typing
+    indicators; any error is printed rather than raised.
+
+    """
+    def call():
+        try:
+            return f(*args)
+        except Exception:
+            traceback.print_exc()
+    return _background_executor.submit(call)
+
 #endregion
 
 #region BotConnector Attachment API
 
 def get_attachment_info(service_uri, attachment_id):
-    r = _session.get().get(
+    r = _request('GET',
         _join(service_uri, 'v3', 'attachments', attachment_id),
         headers={'Accept': 'application/json'},
     )
     return _raise_or_get_json(r)
 
 def get_attachment(service_uri, attachment_id, view_id):
-    r = _session.get().get(
+    r = _request('GET',
         _join(service_uri, 'v3', 'attachments', attachment_id, 'views', view_id),
         headers={'Accept': 'application/json'},
     )
@@ -156,7 +320,7 @@ def get_attachment(service_uri, attachment_id, view_id):
 #region BotConnector API
 
 def create_conversation(service_uri, topic_name, bot_id, bot_name, member_id_name_pairs):
-    r = _session.get().post(
+    r = _request('POST',
         _join(service_uri, 'v3', 'conversations'),
         headers={'Accept': 'application/json'},
         json={
@@ -168,7 +332,7 @@ def create_conversation(service_uri, topic_name, bot_id, bot_name, member_id_nam
     return _raise_or_get_json(r)
 
 def send_to_conversation(service_uri, conversation_id, activity):
-    r = _session.get().post(
+    r = _request('POST',
         _join(service_uri, 'v3', 'conversations', conversation_id, 'activities'),
         headers={'Accept': 'application/json'},
         json=activity,
@@ -176,7 +340,7 @@ def send_to_conversation(service_uri, conversation_id, activity):
     return _raise_or_get_json(r)
 
 def reply_to_activity(service_uri, conversation_id, activity_id, activity):
-    r = _session.get().post(
+    r = _request('POST',
         _join(service_uri, 'v3', 'conversations', conversation_id, 'activities', activity_id),
         headers={'Accept': 'application/json'},
         json=activity,
@@ -184,34 +348,97 @@ def reply_to_activity(service_uri, conversation_id, activity_id, activity):
     return _raise_or_get_json(r)
 
 def get_conversation_members(service_uri, conversation_id):
-    r = _session.get().get(
+    r = _request('GET',
         _join(service_uri, 'v3', 'conversations', conversation_id, 'members'),
         headers={'Accept': 'application/json'},
     )
     return _raise_or_get_json(r)
 
 def get_activity_members(service_uri, conversation_id, activity_id):
-    r = _session.get().get(
+    r = _request('GET',
         _join(service_uri, 'v3', 'conversations', conversation_id, 'activities', activity_id, 'members'),
         headers={'Accept': 'application/json'},
     )
     return _raise_or_get_json(r)
 
 def upload_attachment(service_uri, conversation_id, type, name, data_bytes, thumbnail_data_bytes=None):
-    data = {
-        'type': type,
-        'name': name,
-        'originalBase64': b64encode(data_bytes).decode(),
-    }
-    if thumbnail_data:
-        data['thumbnailBase64'] = b64encode(thumbnail_data_bytes).decode()
-    
-    r = _session.get().post(
+    """Uploads an attachment, streaming its base64 json body.
+
+    data_bytes and thumbnail_data_bytes are bytes-like objects or binary
+    files.  The body is encoded a chunk at a time as it is sent, so only
+    one chunk of its base64 is held in memory at once.
+
+    """
+    r = _request('POST',
         _join(service_uri, 'v3', 'conversations', conversation_id, 'attachments'),
-        headers={'Accept': 'application/json'},
-        json=data,
+        headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
+        data=_attachment_body(type, name, data_bytes, thumbnail_data_bytes),
+        # The body generator cannot be replayed.
+        retry=False,
     )
     return _raise_or_get_json(r)
 
+def download_attachment(service_uri, attachment_id, view_id, destination):
+    """Streams an attachment view to destination, a chunk at a time.
+
+    destination is a file path, a binary file, or a function that is
+    called with each chunk of bytes.  Returns the number of bytes written.
+
+    """
+    r = _request('GET',
+        _join(service_uri, 'v3', 'attachments', attachment_id, 'views', view_id),
+        stream=True,
+    )
+    with contextlib.closing(r):
+        if r.status_code >= 400:
+            return _raise_or_get_json(r)
+        if callable(destination):
+            return _write_chunks(r, destination)
+        if hasattr(destination, 'write'):
+            return _write_chunks(r, destination.write)
+        with open(destination, 'wb') as f:
+            return _write_chunks(r, f.write)
+
+def _write_chunks(response, write):
+    size = 0
+    for chunk in response.iter_content(_STREAM_CHUNK_SIZE):
+        write(chunk)
+        size += len(chunk)
+    return size
+
+def _attachment_body(type, name, data, thumbnail_data=None):
+    """Yields the json body of an attachment upload, in chunks of bytes."""
+    yield '{{"type": {}, "name": {}, "originalBase64": "'.format(json.dumps(type), json.dumps(name)).encode()
+    yield from _iter_base64(data)
+    if thumbnail_data:
+        yield b'", "thumbnailBase64": "'
+        yield from _iter_base64(thumbnail_data)
+    yield b'"}'
+
+def _iter_base64(source):
+    """Yields the base64 of source, a bytes-like object or binary file, in pieces."""
+    remainder = b''
+    for chunk in _iter_chunks(source):
+        chunk = remainder + chunk
+        # Only whole 3-byte groups are encoded, so no piece is padded.
+        end = len(chunk) - len(chunk) % 3
+        if end:
+            yield b64encode(chunk[:end])
+        remainder = chunk[end:]
+    if remainder:
+        yield b64encode(remainder)
+
+def _iter_chunks(source):
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(_STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        view = memoryview(source)
+        for start in range(0, len(view), _STREAM_CHUNK_SIZE):
+            yield view[start:start + _STREAM_CHUNK_SIZE].tobytes()
+
 #endregion
 
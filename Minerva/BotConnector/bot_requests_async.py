@@ -0,0 +1,248 @@
+"""An asyncio variant of bot_requests, built on aiohttp.
+
+Each function has the same name and arguments as its bot_requests
+counterpart, but is a coroutine, so one event loop can have many
+connector and state calls in flight at once.  The two modules share the
+connector token, the timeouts, the error mapping and the Bot Framework
+dependency's retries and circuit breaker; each event loop keeps one
+aiohttp session, whose connection pool is reused by every call.
+
+aiohttp is optional; without it, every call raises RuntimeError.
+
+"""
+import asyncio
+import json
+import weakref
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import bot_requests
+import resilience
+from bot_requests import _join, _state_headers
+
+# The most connections each event loop's session keeps open.
+_CONNECTION_LIMIT = 100
+
+# Event loop: aiohttp.ClientSession.
+_sessions = weakref.WeakKeyDictionary()
+
+def _require_aiohttp():
+    if aiohttp is None:
+        raise RuntimeError("bot_requests_async requires the aiohttp package.")
+
+def _client_session():
+    _require_aiohttp()
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=_CONNECTION_LIMIT),
+            timeout=aiohttp.ClientTimeout(sock_connect=bot_requests.CONNECT_TIMEOUT,
+                                          sock_read=bot_requests.READ_TIMEOUT),
+        )
+        _sessions[loop] = session
+    return session
+
+async def fetch(url, timeout=None):
+    """GETs url from a service other than the Bot Framework.
+
+    Returns the aiohttp response with its body already read, so that its
+    json() can be awaited after the connection is released.  timeout is a
+    (connect, read) pair in seconds, as for requests.
+
+    """
+    _require_aiohttp()
+    if timeout is not None:
+        timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    async with _client_session().get(url, timeout=timeout) as response:
+        await response.read()
+        return response
+
+async def close():
+    """Closes the current event loop's session and its connections."""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+async def _authorization_headers():
+    """Returns the headers that authorize a call, from bot_requests' session."""
+    session = bot_requests._session
+    if session.needs_refresh():
+        # Fetching a token blocks, so it is done off the event loop.
+        await asyncio.get_running_loop().run_in_executor(None, session.get)
+    authorization = session.get().headers.get('Authorization')
+    return {'Authorization': authorization} if authorization else {}
+
+async def _request(method, url, headers=None, json=None, not_modified=False, data=None, retry=True):
+    """Makes a call and returns its json, as bot_requests._raise_or_get_json does.
+
+    The call goes through the Bot Framework dependency's retries and
+    circuit breaker, as bot_requests._request does.  When not_modified is
+    True, a 304 response returns None.  data, if given, is the body, such
+    as an async generator of bytes, in place of json.
+
+    """
+    all_headers = await _authorization_headers()
+    all_headers.update(headers or {})
+
+    async def attempt():
+        async with _client_session().request(method, url, headers=all_headers, json=json, data=data) as response:
+            return response, await response.read()
+
+    response, body = await bot_requests._bot_framework.call_async(
+        attempt, idempotent=method in ('GET', 'DELETE'), retry=retry,
+        is_failure=lambda result: resilience.is_failed_response(result[0]),
+    )
+    if not_modified and response.status == 304:
+        return None
+    if response.status == 403:
+        print(response.request_info.headers)
+        print(response.headers)
+    return _raise_or_get_json(response, body)
+
+def _raise_or_get_json(response, body):
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError:
+        data = None
+    if response.status >= 400:
+        # An error without a json message, such as an HTML page, still raises.
+        error = bot_requests._error_from_json(data)
+        if error is not None:
+            raise error
+        response.raise_for_status()
+    return data if data is not None else {}
+
+#region BotState API
+
+async def delete_state_for_user(state_uri, channel_id, user_id):
+    await _request('DELETE', _join(state_uri, 'v3', 'botstate', channel_id, 'users', user_id))
+
+async def get_user_data(state_uri, channel_id, user_id, etag=None):
+    return await _request(
+        'GET', _join(state_uri, 'v3', 'botstate', channel_id, 'users', user_id),
+        headers=_state_headers(etag), not_modified=True,
+    )
+
+async def set_user_data(state_uri, channel_id, user_id, etag_and_data):
+    return await _request(
+        'POST', _join(state_uri, 'v3', 'botstate', channel_id, 'users', user_id),
+        headers={'Accept': 'application/json'}, json=etag_and_data,
+    )
+
+async def get_conversation_data(state_uri, channel_id, conversation_id, etag=None):
+    return await _request(
+        'GET', _join(state_uri, 'v3', 'botstate', channel_id, 'conversations', conversation_id),
+        headers=_state_headers(etag), not_modified=True,
+    )
+
+async def set_conversation_data(state_uri, channel_id, conversation_id, etag_and_data):
+    return await _request(
+        'POST', _join(state_uri, 'v3', 'botstate', channel_id, 'conversations', conversation_id),
+        headers={'Accept': 'application/json'}, json=etag_and_data,
+    )
+
+async def get_private_conversation_data(state_uri, channel_id, conversation_id, user_id, etag=None):
+    return await _request(
+        'GET', _join(state_uri, 'v3', 'botstate', channel_id, 'conversations', conversation_id, 'users', user_id),
+        headers=_state_headers(etag), not_modified=True,
+    )
+
+async def set_private_conversation_data(state_uri, channel_id, conversation_id, user_id, etag_and_data):
+    return await _request(
+        'POST', _join(state_uri, 'v3', 'botstate', channel_id, 'conversations', conversation_id, 'users', user_id),
+        headers={'Accept': 'application/json'}, json=etag_and_data,
+    )
+
+async def fetch_concurrently(calls):
+    """Awaits each (coroutine function, args) pair in calls at the same time.
+
+    Returns the results in the same order as calls.
+
+    """
+    return await asyncio.gather(*[f(*args) for f, args in calls])
+
+#endregion
+
+#region BotConnector Attachment API
+
+async def get_attachment_info(service_uri, attachment_id):
+    return await _request(
+        'GET', _join(service_uri, 'v3', 'attachments', attachment_id),
+        headers={'Accept': 'application/json'},
+    )
+
+async def get_attachment(service_uri, attachment_id, view_id):
+    return await _request(
+        'GET', _join(service_uri, 'v3', 'attachments', attachment_id, 'views', view_id),
+        headers={'Accept': 'application/json'},
+    )
+
+#endregion
+
+#region BotConnector API
+
+async def create_conversation(service_uri, topic_name, bot_id, bot_name, member_id_name_pairs):
+    return await _request(
+        'POST', _join(service_uri, 'v3', 'conversations'),
+        headers={'Accept': 'application/json'},
+        json={
+            'topicName': topic_name,
+            'bot': { 'id': bot_id, 'name': bot_name },
+            'members': [{'id': id, 'name': name} for id, name in member_id_name_pairs]
+        },
+    )
+
+async def send_to_conversation(service_uri, conversation_id, activity):
+    return await _request(
+        'POST', _join(service_uri, 'v3', 'conversations', conversation_id, 'activities'),
+        headers={'Accept': 'application/json'}, json=activity,
+    )
+
+async def reply_to_activity(service_uri, conversation_id, activity_id, activity):
+    return await _request(
+        'POST', _join(service_uri, 'v3', 'conversations', conversation_id, 'activities', activity_id),
+        headers={'Accept': 'application/json'}, json=activity,
+    )
+
+async def get_conversation_members(service_uri, conversation_id):
+    return await _request(
+        'GET', _join(service_uri, 'v3', 'conversations', conversation_id, 'members'),
+        headers={'Accept': 'application/json'},
+    )
+
+async def get_activity_members(service_uri, conversation_id, activity_id):
+    return await _request(
+        'GET', _join(service_uri, 'v3', 'conversations', conversation_id, 'activities', activity_id, 'members'),
+        headers={'Accept': 'application/json'},
+    )
+
+async def upload_attachment(service_uri, conversation_id, type, name, data_bytes, thumbnail_data_bytes=None):
+    """Uploads an attachment, streaming its base64 json body as bot_requests.upload_attachment does.
+
+    The body is encoded a chunk at a time on the default executor, so the
+    event loop never waits on reading a binary file.
+
+    """
+    body = bot_requests._attachment_body(type, name, data_bytes, thumbnail_data_bytes)
+    return await _request(
+        'POST', _join(service_uri, 'v3', 'conversations', conversation_id, 'attachments'),
+        headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
+        data=_iter_async(body),
+        # The body generator cannot be replayed.
+        retry=False,
+    )
+
+async def _iter_async(chunks):
+    """Yields each chunk of a blocking iterator, advanced off the event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+#endregion
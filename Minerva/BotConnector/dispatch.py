@@ -0,0 +1,136 @@
+"""Runs bot handlers on a bounded pool of background worker threads.
+
+With a Dispatcher, the webhook only has to validate an activity and
+submit it; the HTTP request is answered at once while a worker runs the
+handler, which delivers its replies through bot_requests.  The queue is
+bounded, so a backlog is refused with QueueFullError rather than
+growing without limit.
+
+"""
+import queue
+import threading
+import time
+import traceback
+
+_DEFAULT_WORKERS = 4
+_DEFAULT_QUEUE_SIZE = 100
+
+
+class QueueFullError(Exception):
+
+    """Raised when an activity is submitted to a full dispatch queue."""
+
+
+class Dispatcher:
+
+    """A bounded queue of messages worked by a fixed pool of threads."""
+
+    def __init__(self, handler, workers=_DEFAULT_WORKERS, queue_size=_DEFAULT_QUEUE_SIZE):
+        self._handler = handler
+        self._workers = workers
+        self._queue = queue.Queue(queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def start(self):
+        """Starts the worker threads, once."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._work, name='dispatch-{}'.format(i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Lets the workers finish the queued messages, then stops them.
+
+        Given a timeout, waits at most that many seconds in all, even while
+        the queue is full, and leaves any workers still busy to finish on
+        their own.
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        threads, self._threads = self._threads, []
+        try:
+            for _ in threads:
+                self._queue.put((None, None), timeout=_remaining(deadline))
+        except queue.Full:
+            return
+        for thread in threads:
+            thread.join(_remaining(deadline))
+
+    def submit(self, msg):
+        """Queues msg for a worker, or raises QueueFullError."""
+        try:
+            self._queue.put_nowait((time.monotonic(), msg))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise QueueFullError("The dispatch queue is full ({} messages).".format(self._queue.maxsize))
+
+    def metrics(self):
+        """Returns a dict of the queue's depth and age and the workers' counters.
+
+        Ages and waits are in seconds.  oldest_age is how long the message
+        at the head of the queue has been waiting.
+
+        """
+        with self._queue.mutex:
+            depth = len(self._queue.queue)
+            oldest_age = time.monotonic() - self._queue.queue[0][0] if depth else 0.0
+        with self._lock:
+            done = self._processed + self._failed
+            return {
+                'depth': depth,
+                'capacity': self._queue.maxsize,
+                'oldest_age': oldest_age,
+                'workers': len(self._threads),
+                'busy': self._busy,
+                'processed': self._processed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'average_wait': self._total_wait / done if done else 0.0,
+                'max_wait': self._max_wait,
+            }
+
+    def _work(self):
+        while True:
+            enqueued_at, msg = self._queue.get()
+            if msg is None:
+                self._queue.task_done()
+                return
+            wait = time.monotonic() - enqueued_at
+            with self._lock:
+                self._busy += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+            try:
+                self._handler(msg)
+            except Exception:
+                # The channel was answered long ago; log and move on.
+                traceback.print_exc()
+                failed = True
+            else:
+                failed = False
+            finally:
+                self._queue.task_done()
+            with self._lock:
+                self._busy -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._processed += 1
+
+
+def _remaining(deadline):
+    """Returns the seconds left until deadline, or None when there is none."""
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
@@ -0,0 +1,106 @@
+"""Processes each activity once, even when the channel redelivers it.
+
+The Bot Framework sends an activity again when the webhook is slow to
+answer.  An ActivityCache remembers the activities that are in flight or
+were completed recently, keyed by their activity id, so a redelivered
+activity waits for or reuses the result of the first delivery instead of
+running the bot's pipeline a second time.
+
+"""
+import collections
+import threading
+import time
+
+_DEFAULT_TTL = 300
+_DEFAULT_MAX_SIZE = 10000
+
+
+class _Entry:
+    def __init__(self):
+        self.done = threading.Event()
+        self.completed_at = None
+        self.result = None
+
+
+class ActivityCache:
+
+    """The in-flight and recently completed activities, by key."""
+
+    def __init__(self, ttl=_DEFAULT_TTL, max_size=_DEFAULT_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.duplicates = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """True for the first delivery of the activity key, False for a duplicate.
+
+        The first delivery must be followed by end(key, ...).
+
+        """
+        with self._lock:
+            self._prune()
+            if key in self._entries:
+                self.duplicates += 1
+                return False
+            self._entries[key] = _Entry()
+            return True
+
+    def end(self, key, result=None, failed=False):
+        """Records the first delivery's result, or forgets it when it failed.
+
+        A failed activity is forgotten so that a redelivery can try again.
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if failed:
+                del self._entries[key]
+            else:
+                entry.result = result
+                entry.completed_at = time.monotonic()
+        entry.done.set()
+
+    def run(self, key, f, wait_timeout=None):
+        """Returns f() for the first delivery of key, or its result for a duplicate.
+
+        A duplicate waits up to wait_timeout seconds for the first delivery
+        to finish, and returns None if it has not.  If the first delivery
+        failed, the duplicate runs f itself.
+
+        """
+        while not self.begin(key):
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if not entry.done.wait(wait_timeout):
+                return None
+            if entry.completed_at is not None:
+                return entry.result
+
+        try:
+            result = f()
+        except Exception:
+            self.end(key, failed=True)
+            raise
+        self.end(key, result)
+        return result
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _prune(self):
+        # Entries are kept in delivery order, so the oldest are at the front.
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.completed_at is None:
+                # In flight entries are never evicted.
+                return
+            if now - entry.completed_at <= self.ttl and len(self._entries) < self.max_size:
+                return
+            del self._entries[key]
@@ -0,0 +1,253 @@
+"""Handles each conversation's messages one at a time, in arrival order.
+
+Two messages of one conversation must not be handled at once: both
+would load the same conversation state, and the last to save it would
+win.  Mailboxes keeps a mailbox per conversation, so its turns are
+handled in the order they arrived while different conversations are
+still handled in parallel, without a lock shared between them.
+
+A message waits in its conversation's mailbox until the turns before it
+are done.  It is then handled either by the thread or coroutine that
+delivered it, with run() or run_async(), which return the handler's
+result, or, when delivered with post(), by whichever thread is handling
+the conversation at the time, so the poster need not wait.
+
+Users often split one question over several quick messages.  Given a
+merge function, the turn that holds a conversation first waits until no
+message has arrived for window seconds, then merges the messages waiting
+behind it into its own and handles them as one.  Only the messages that
+directly follow it from the same sender are merged, so in a group
+conversation one user's message never absorbs another's, and nothing is
+merged into a message that answers a question the bot asked.  The merged
+messages' turns are skipped; run() and run_async() return None for them.
+
+"""
+import asyncio
+import collections
+import threading
+import time
+import traceback
+
+# The longest a turn waits for more messages, in windows.
+_MAX_WINDOWS = 4
+
+
+class _Letter:
+
+    """A message in a mailbox, and how to tell its sender that its turn has come."""
+
+    def __init__(self, handler, item, wake=None):
+        self.handler = handler
+        self.item = item
+        # None when the letter is handled by whoever holds the mailbox.
+        self.wake = wake
+        self.arrived_at = time.monotonic()
+        # Set when the letter was merged into an earlier one.
+        self.superseded = False
+        # Whether later letters may be merged into it, once asked.
+        self.open = None
+
+
+class Mailboxes:
+
+    """The mailboxes of the conversations with messages being handled.
+
+    merge(item, later_item), if given, returns item with later_item merged
+    into it; without it, messages are never merged.  sender(item), if
+    given, returns who sent item, and only items of the same sender are
+    merged.  hold(item), if given, returns True when item must be handled
+    on its own, such as a reply to a question; it is called when item's
+    turn comes, on a worker thread for run_async().
+
+    """
+
+    def __init__(self, merge=None, window=0.0, sender=None, hold=None):
+        self.merge = merge
+        self.window = window
+        self.sender = sender
+        self.hold = hold
+        # Key: deque of letters, the first of which holds the turn.
+        self._boxes = {}
+        self._lock = threading.Lock()
+        self.waits = 0
+        self.coalesced = 0
+
+    def run(self, key, handler, item):
+        """Returns handler(item) once the earlier messages for key are handled."""
+        turn = threading.Event()
+        letter = _Letter(handler, item, turn.set)
+        if not self._deliver(key, letter):
+            turn.wait()
+            if letter.superseded:
+                return None
+        try:
+            self._wait_quietly(key, letter)
+            return handler(self._coalesce(key, letter))
+        finally:
+            self._finish(key)
+
+    async def run_async(self, key, handler, item):
+        """A coroutine that returns await handler(item), as run() returns handler(item)."""
+        loop = asyncio.get_running_loop()
+        turn = loop.create_future()
+        letter = _Letter(handler, item, lambda: loop.call_soon_threadsafe(_set_turn, turn))
+        if not self._deliver(key, letter):
+            try:
+                await turn
+            except asyncio.CancelledError:
+                self._withdraw(key, letter)
+                raise
+            if letter.superseded:
+                return None
+        try:
+            if self.merge is not None and self.hold is not None:
+                # hold may read state, so it is kept off the event loop.
+                await loop.run_in_executor(None, self._is_open, letter)
+            await self._wait_quietly_async(key, letter)
+            return await handler(self._coalesce(key, letter))
+        finally:
+            self._finish(key)
+
+    def post(self, key, handler, item):
+        """Calls handler(item) now if key is idle, or leaves it to the thread handling key.
+
+        Exceptions raised by the handler of a message handled for another
+        poster are printed, since there is no one to raise them to.
+
+        """
+        letter = _Letter(handler, item)
+        if self._deliver(key, letter):
+            try:
+                self._wait_quietly(key, letter)
+                handler(self._coalesce(key, letter))
+            finally:
+                self._finish(key)
+
+    def metrics(self):
+        """Returns a dict of the conversations being handled and the messages waiting.
+
+        waits counts every message that has had to wait for its turn, and
+        coalesced every message merged into an earlier one.
+
+        """
+        with self._lock:
+            return {
+                'conversations': len(self._boxes),
+                'waiting': sum(len(box) - 1 for box in self._boxes.values()),
+                'waits': self.waits,
+                'coalesced': self.coalesced,
+            }
+
+    def _is_open(self, letter):
+        """True when later letters may be merged into letter."""
+        if self.merge is None:
+            return False
+        if letter.open is None:
+            letter.open = self.hold is None or not self.hold(letter.item)
+        return letter.open
+
+    def _quiet_time(self, key, letter):
+        """Returns the seconds left to wait before letter's turn, which holds key's mailbox, starts.
+
+        A turn waits until no message has arrived for window seconds, and
+        at most _MAX_WINDOWS windows after its own message arrived.
+
+        """
+        if self.window <= 0 or not self._is_open(letter):
+            return 0
+        with self._lock:
+            box = self._boxes[key]
+            deadline = min(box[-1].arrived_at + self.window, box[0].arrived_at + self.window * _MAX_WINDOWS)
+        return deadline - time.monotonic()
+
+    def _wait_quietly(self, key, letter):
+        while True:
+            remaining = self._quiet_time(key, letter)
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    async def _wait_quietly_async(self, key, letter):
+        while True:
+            remaining = self._quiet_time(key, letter)
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    def _coalesce(self, key, letter):
+        """Merges the letters waiting behind letter, which holds the turn, into it.
+
+        Only the letters directly behind it from the same sender are
+        merged, and none when hold(letter.item) is True.  Returns the
+        merged item.  The merged letters are taken out of the mailbox, and
+        their senders woken to find them superseded.
+
+        """
+        if not self._is_open(letter):
+            return letter.item
+        with self._lock:
+            box = self._boxes[key]
+            later = []
+            while len(box) > 1 and self._same_sender(letter, box[1]):
+                later.append(box[1])
+                del box[1]
+            for merged in later:
+                merged.superseded = True
+            self.coalesced += len(later)
+        for merged in later:
+            letter.item = self.merge(letter.item, merged.item)
+            if merged.wake is not None:
+                merged.wake()
+        return letter.item
+
+    def _same_sender(self, letter, later):
+        return self.sender is None or self.sender(letter.item) == self.sender(later.item)
+
+    def _deliver(self, key, letter):
+        """Adds letter to key's mailbox; True when it holds the turn at once."""
+        with self._lock:
+            box = self._boxes.get(key)
+            if box is None:
+                self._boxes[key] = collections.deque([letter])
+                return True
+            box.append(letter)
+            self.waits += 1
+            return False
+
+    def _finish(self, key):
+        """Ends the current turn and passes the next to the next letter in key's mailbox."""
+        while True:
+            with self._lock:
+                box = self._boxes[key]
+                box.popleft()
+                if not box:
+                    del self._boxes[key]
+                    return
+                letter = box[0]
+            if letter.wake is not None:
+                letter.wake()
+                return
+            # A posted letter; handle it here.
+            try:
+                self._wait_quietly(key, letter)
+                letter.handler(self._coalesce(key, letter))
+            except Exception:
+                traceback.print_exc()
+
+    def _withdraw(self, key, letter):
+        """Removes the letter of a cancelled run_async() from key's mailbox."""
+        if letter.superseded:
+            return
+        with self._lock:
+            box = self._boxes[key]
+            holds_turn = box[0] is letter
+            if not holds_turn:
+                box.remove(letter)
+        if holds_turn:
+            # Its turn came as it was cancelled, so pass the turn on.
+            self._finish(key)
+
+
+def _set_turn(future):
+    if not future.done():
+        future.set_result(None)
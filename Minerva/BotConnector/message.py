@@ -1,9 +1,79 @@
 from datetime import datetime
 import json
 import bot_requests
+import bot_requests_async
+import state_store
 
 _STATE_URI = 'https://state.botframework.com'
 
+def _fingerprint(data):
+    """Returns a comparable snapshot of data, or None if it cannot be made."""
+    try:
+        return json.dumps(data, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+
+def _has_changed(data, fingerprint):
+    """True when data differs from the snapshot taken when it was loaded.
+
+    Data that was never loaded nor assigned has nothing to write.  Data
+    that cannot be snapshotted is always treated as changed.
+
+    """
+    if data is None:
+        return False
+    current = _fingerprint(data)
+    return current is None or current != fingerprint
+
+# Hold a conversation's data and snapshot data when a store keeps them in one record.
+_DATA_KEY = '__data__'
+_SNAPSHOT_KEY = '__snapshot__'
+
+def _join_record(data, snapshot):
+    """Returns the record that holds data and snapshot, or data alone when there is no snapshot."""
+    if not snapshot:
+        return data
+    return {_DATA_KEY: data, _SNAPSHOT_KEY: snapshot}
+
+def _split_record(record):
+    """Returns the (data, snapshot) held by a record made by _join_record."""
+    if isinstance(record, dict) and _SNAPSHOT_KEY in record:
+        return record.get(_DATA_KEY), record[_SNAPSHOT_KEY]
+    return record, None
+
+# Joins the texts of activities merged by an Outbox.
+_TEXT_SEPARATOR = '\n\n'
+_MERGED_KEYS = ('text', 'attachments', 'entities')
+
+def _can_merge(first, second):
+    """True when the activities differ only in their text, attachments and entities."""
+    return ({k: v for k, v in first.items() if k not in _MERGED_KEYS} ==
+            {k: v for k, v in second.items() if k not in _MERGED_KEYS})
+
+def _merge_activities(activities):
+    """Returns activities with each run of mergeable activities joined into one."""
+    merged = []
+    for activity in activities:
+        if merged and _can_merge(merged[-1], activity):
+            last = merged[-1]
+            last['text'] = _TEXT_SEPARATOR.join(filter(None, [last.get('text'), activity.get('text')]))
+            for key in ('attachments', 'entities'):
+                if key in activity:
+                    last[key] = last.get(key, []) + activity[key]
+        else:
+            merged.append(dict(activity))
+    return merged
+
+def _merge_runs(held):
+    """Returns the (reply, activity) pairs of held with each run of posts or replies merged."""
+    runs = []
+    for reply, activity in held:
+        if runs and runs[-1][0] == reply:
+            runs[-1][1].append(activity)
+        else:
+            runs.append((reply, [activity]))
+    return [(reply, activity) for reply, activities in runs for activity in _merge_activities(activities)]
+
 class User:
     def __init__(self, state_uri, channel_id, conversation_id, data):
         self._state_uri = state_uri
@@ -12,34 +82,126 @@ class User:
         self._data = data
         self._id = data['id']
         self.name = data.get('name', '')
-        self.data = {}
+        self._user_data = None
         self._etag = '*'
-        self.conversation_data = {}
+        self._conversation_data = None
         self._conversation_etag = '*'
-        self.reload_data()
+
+        # Write tracking, see StateSession.
+        self._deferred = False
+        self._dirty = set()
+        self._fingerprints = {}
+
+    @property
+    def data(self):
+        """The user's data, fetched from the state store on first access."""
+        if self._user_data is None:
+            self._load_user_data()
+        return self._user_data
+
+    @data.setter
+    def data(self, value):
+        self._user_data = value
+
+    @property
+    def conversation_data(self):
+        """The user's private conversation data, fetched on first access."""
+        if self._conversation_data is None:
+            self._load_conversation_data()
+        return self._conversation_data
+
+    @conversation_data.setter
+    def conversation_data(self, value):
+        self._conversation_data = value
 
     def save_data(self, include_data=True, include_conversation_data=True):
         if include_data:
-            data = {'data': self.data, 'eTag': self._etag}
-            bot_requests.set_user_data(self._state_uri, self._channel_id, self._id, data)
+            self._dirty.add('user')
         if include_conversation_data:
-            data = {'data': self.conversation_data, 'eTag': self._conversation_etag}
-            bot_requests.set_private_conversation_data(self._state_uri, self._channel_id, self._conversation_id, self._id, data)
+            self._dirty.add('private')
+        if not self._deferred:
+            self.flush_data()
+
+    def flush_data(self):
+        """Posts each dirty scope whose data changed since it was loaded."""
+        for key, data, written in self._pending_writes():
+            written(state_store.get_store().set(key, data))
+        self._dirty.clear()
+
+    async def flush_data_async(self):
+        """A coroutine that does what flush_data() does."""
+        for key, data, written in self._pending_writes():
+            written(await state_store.get_store().set_async(key, data))
+        self._dirty.clear()
+
+    def _pending_writes(self):
+        """Returns (key, etag_and_data, written) for each scope to post.
+
+        written must be called with the store's result once it is posted.
+
+        """
+        writes = []
+        if 'user' in self._dirty and _has_changed(self._user_data, self._fingerprints.get('user')):
+            writes.append((self._user_key(), {'data': self._user_data, 'eTag': self._etag}, self._user_written))
+        if 'private' in self._dirty and _has_changed(self._conversation_data, self._fingerprints.get('private')):
+            writes.append((self._conversation_key(), {'data': self._conversation_data, 'eTag': self._conversation_etag},
+                           self._conversation_written))
+        return writes
+
+    def _user_written(self, result):
+        self._etag = result.get('eTag', self._etag)
+        self._fingerprints['user'] = _fingerprint(self._user_data)
+
+    def _conversation_written(self, result):
+        self._conversation_etag = result.get('eTag', self._conversation_etag)
+        self._fingerprints['private'] = _fingerprint(self._conversation_data)
 
     def reload_data(self):
-        data = bot_requests.get_user_data(self._state_uri, self._channel_id, self._id)
-        self.data = data.get('data') or {}
+        """Discards any loaded data so that it is fetched again on next access."""
+        self._user_data = None
+        self._etag = '*'
+        self._conversation_data = None
+        self._conversation_etag = '*'
+
+    def _load_user_data(self):
+        self._set_user_data(state_store.get_store().get(self._user_key()))
+
+    def _load_conversation_data(self):
+        self._set_conversation_data(state_store.get_store().get(self._conversation_key()))
+
+    def _user_key(self):
+        return state_store.user_key(self._state_uri, self._channel_id, self._id)
+
+    def _conversation_key(self):
+        return state_store.private_conversation_key(self._state_uri, self._channel_id, self._conversation_id, self._id)
+
+    def _set_user_data(self, data):
+        self._user_data = data.get('data') or {}
         self._etag = data.get('eTag', '*')
-        data = bot_requests.get_private_conversation_data(self._state_uri, self._channel_id, self._conversation_id, self._id)
-        self.conversation_data = data.get('data') or {}
+        self._fingerprints['user'] = _fingerprint(self._user_data)
+
+    def _set_conversation_data(self, data):
+        self._conversation_data = data.get('data') or {}
         self._conversation_etag = data.get('eTag', '*')
+        self._fingerprints['private'] = _fingerprint(self._conversation_data)
+
+    def _pending_loads(self, include_data, include_conversation_data):
+        """Returns (key, setter) pairs for each requested scope not yet loaded."""
+        loads = []
+        if include_data and self._user_data is None:
+            loads.append((self._user_key(), self._set_user_data))
+        if include_conversation_data and self._conversation_data is None:
+            loads.append((self._conversation_key(), self._set_conversation_data))
+        return loads
 
     def delete_data(self):
-        bot_requests.delete_state_for_user(self._state_uri, self._channel_id, self._id)
+        state_store.get_store().delete(self._user_key())
         self.data = {}
         self._etag = '*'
         self.conversation_data = {}
         self._conversation_etag = '*'
+        self._fingerprints = {'user': _fingerprint({}), 'private': _fingerprint({})}
+        self._dirty.clear()
 
 class Message:
     def __init__(self, data):
@@ -58,23 +220,235 @@ class Message:
         self.attachments = list(data.get('attachments', []))
         self.entities = list(data.get('entities', []))
 
-        self.from_user = User(self._service_uri, self._channel_id, self._conversation_id, data['from'])
-        self.recipient = User(self._service_uri, self._channel_id, self._conversation_id, data['recipient'])
+        # Later messages of a burst merged into this one, see absorb().
+        self.absorbed = []
 
-        self.data = {}
+        self.from_user = User(self._state_uri, self._channel_id, self._conversation_id, data['from'])
+        self.recipient = User(self._state_uri, self._channel_id, self._conversation_id, data['recipient'])
+
+        self._conversation_data = None
         self._etag = '*'
-        self.reload_data()
+        self._snapshot_data = None
+        self._snapshot_etag = '*'
+
+        # Activities held back by an open Outbox, as (reply, activity).
+        self._outbox = None
+
+        # Write tracking, see StateSession.
+        self._deferred = False
+        self._dirty = set()
+        self._fingerprints = {}
+
+    @property
+    def data(self):
+        """The conversation's data, fetched from the state store on first access."""
+        if self._conversation_data is None:
+            self._load_data()
+        return self._conversation_data
+
+    @data.setter
+    def data(self, value):
+        self._conversation_data = value
+
+    @property
+    def snapshot_data(self):
+        """The conversation's snapshot data, fetched on first access.
+
+        Like data, it is shared by everyone in the conversation.  Stores
+        with separate_snapshots keep it apart from data, so large values
+        that change rarely are not posted again by every turn that changes
+        data.  Other stores keep both in the conversation's record, so
+        that a turn still makes a single read and a single write.
+
+        """
+        if self._snapshot_data is None:
+            if self._separate_snapshots():
+                self._set_snapshot_data(state_store.get_store().get(self._snapshot_key()))
+            else:
+                # Data that was assigned but not loaded is kept.
+                data = self._conversation_data
+                self._load_data()
+                if data is not None:
+                    self._conversation_data = data
+        return self._snapshot_data
+
+    @snapshot_data.setter
+    def snapshot_data(self, value):
+        self._snapshot_data = value
 
     def reload_data(self):
-        data = bot_requests.get_conversation_data(self._state_uri, self._channel_id, self._conversation_id)
-        self.data = data.get('data') or {}
+        """Discards any loaded data so that it is fetched again on next access."""
+        self._conversation_data = None
+        self._etag = '*'
+        self._snapshot_data = None
+        self._snapshot_etag = '*'
+
+    def load_data(self, conversation_data=True, user_data=False, private_conversation_data=False,
+                  include_recipient=False, snapshot_data=False):
+        """Fetches every requested state scope at once.
+
+        Scopes that have already been loaded are skipped.  User scopes are
+        loaded for from_user, and also for recipient when include_recipient
+        is True; snapshot_data loads the conversation's snapshot data.  The
+        state store fetches them together; for the state service the
+        requests are issued concurrently, so the time taken is close to
+        that of the slowest single request.
+
+        """
+        loads = self._pending_loads(conversation_data, user_data, private_conversation_data, include_recipient,
+                                    snapshot_data)
+        results = state_store.get_store().get_many([key for key, _ in loads])
+        for (_, setter), data in zip(loads, results):
+            setter(data)
+
+    async def load_data_async(self, conversation_data=True, user_data=False, private_conversation_data=False,
+                              include_recipient=False, snapshot_data=False):
+        """A coroutine that does what load_data() does."""
+        loads = self._pending_loads(conversation_data, user_data, private_conversation_data, include_recipient,
+                                    snapshot_data)
+        results = await state_store.get_store().get_many_async([key for key, _ in loads])
+        for (_, setter), data in zip(loads, results):
+            setter(data)
+
+    def _pending_loads(self, conversation_data, user_data, private_conversation_data, include_recipient,
+                       snapshot_data):
+        """Returns (key, setter) pairs for each requested scope not yet loaded."""
+        loads = []
+        if snapshot_data and self._snapshot_data is None and not self._separate_snapshots():
+            # Loaded with the conversation data.
+            conversation_data, snapshot_data = True, False
+        if conversation_data and self._conversation_data is None:
+            loads.append((self._key(), self._set_data))
+        if snapshot_data and self._snapshot_data is None:
+            loads.append((self._snapshot_key(), self._set_snapshot_data))
+        users = [self.from_user, self.recipient] if include_recipient else [self.from_user]
+        for user in users:
+            loads.extend(user._pending_loads(user_data, private_conversation_data))
+        return loads
+
+    def _load_data(self):
+        self._set_data(state_store.get_store().get(self._key()))
+
+    def _key(self):
+        return state_store.conversation_key(self._state_uri, self._channel_id, self._conversation_id)
+
+    def _snapshot_key(self):
+        return state_store.snapshot_key(self._state_uri, self._channel_id, self._conversation_id)
+
+    def _separate_snapshots(self):
+        return state_store.get_store().separate_snapshots
+
+    def _set_data(self, data):
+        record = data.get('data')
+        if not self._separate_snapshots():
+            record, snapshot = _split_record(record)
+            self._snapshot_data = snapshot or {}
+            self._fingerprints['snapshot'] = _fingerprint(self._snapshot_data)
+        self._conversation_data = record or {}
         self._etag = data.get('eTag', '*')
+        self._fingerprints['conversation'] = _fingerprint(self._conversation_data)
+
+    def _set_snapshot_data(self, data):
+        self._snapshot_data = data.get('data') or {}
+        self._snapshot_etag = data.get('eTag', '*')
+        self._fingerprints['snapshot'] = _fingerprint(self._snapshot_data)
+
+    def save_data(self, include_snapshot_data=False):
+        self._dirty.add('conversation')
+        if include_snapshot_data:
+            self._dirty.add('snapshot')
+        if not self._deferred:
+            self.flush_data()
 
-    def save_data(self):
-        data = {'data': self.data, 'eTag': self._etag}
-        bot_requests.set_conversation_data(self._state_uri, self._channel_id, self._conversation_id, data)
+    def flush_data(self):
+        """Posts the snapshot data, then the conversation data, if dirty and changed since loaded.
+
+        The snapshot data goes first, so that data never refers to a
+        snapshot that failed to be written.  Where both are kept in one
+        record, they are posted together.
+
+        """
+        for key, data, written in self._pending_writes():
+            written(state_store.get_store().set(key, data))
+        self._dirty.clear()
+
+    async def flush_data_async(self):
+        """A coroutine that does what flush_data() does."""
+        for key, data, written in self._pending_writes():
+            written(await state_store.get_store().set_async(key, data))
+        self._dirty.clear()
+
+    def _pending_writes(self):
+        """Returns (key, etag_and_data, written) for each scope to post, as User._pending_writes does."""
+        writes = []
+        if not self._separate_snapshots():
+            if ('snapshot' in self._dirty and _has_changed(self._snapshot_data, self._fingerprints.get('snapshot')) or
+                    'conversation' in self._dirty and _has_changed(self._conversation_data,
+                                                                   self._fingerprints.get('conversation'))):
+                record = _join_record(self._conversation_data, self._snapshot_data)
+                writes.append((self._key(), {'data': record, 'eTag': self._etag}, self._record_written))
+            return writes
+        if 'snapshot' in self._dirty and _has_changed(self._snapshot_data, self._fingerprints.get('snapshot')):
+            writes.append((self._snapshot_key(), {'data': self._snapshot_data, 'eTag': self._snapshot_etag},
+                           self._snapshot_written))
+        if 'conversation' in self._dirty and _has_changed(self._conversation_data, self._fingerprints.get('conversation')):
+            writes.append((self._key(), {'data': self._conversation_data, 'eTag': self._etag}, self._written))
+        return writes
+
+    def _written(self, result):
+        self._etag = result.get('eTag', self._etag)
+        self._fingerprints['conversation'] = _fingerprint(self._conversation_data)
+
+    def _snapshot_written(self, result):
+        self._snapshot_etag = result.get('eTag', self._snapshot_etag)
+        self._fingerprints['snapshot'] = _fingerprint(self._snapshot_data)
+
+    def _record_written(self, result):
+        self._written(result)
+        self._fingerprints['snapshot'] = _fingerprint(self._snapshot_data)
+
+    def activity_key(self):
+        """Returns a key that identifies this activity across redeliveries."""
+        return (self._channel_id, self._conversation_id, self._activity_id)
+
+    def conversation_key(self):
+        """Returns a key that identifies this activity's conversation."""
+        return (self._channel_id, self._conversation_id)
+
+    def sender_key(self):
+        """Returns a key that identifies the user who sent this activity."""
+        return (self._channel_id, self.from_user._id)
+
+    def absorb(self, later):
+        """Merges the text, attachments and entities of a later message into this one.
+
+        Both must have been sent by the same user, see sender_key().
+        Returns self, which is then handled in place of both.
+
+        """
+        self.text = ' '.join(filter(None, [self.text, later.text]))
+        self.attachments.extend(later.attachments)
+        self.entities.extend(later.entities)
+        self.absorbed.append(later)
+        self.absorbed.extend(later.absorbed)
+        return self
+
+    def state_session(self):
+        """Returns a StateSession that defers this message's state writes."""
+        return StateSession(self)
+
+    def outbox(self):
+        """Returns an Outbox that sends this message's posts and replies together."""
+        return Outbox(self)
 
     def post(self, text, attachments=[], entities=[], **extras):
+        self._send(False, self._post_activity(text, attachments, entities, extras))
+
+    async def post_async(self, text, attachments=[], entities=[], **extras):
+        """A coroutine that does what post() does."""
+        await self._send_async(False, self._post_activity(text, attachments, entities, extras))
+
+    def _post_activity(self, text, attachments, entities, extras):
         data = {
             'type': 'message',
             'conversation': {'id': self._conversation_id},
@@ -86,7 +460,7 @@ class Message:
             data['attachments'] = [getattr(a, '_data', a) for a in attachments]
         if entities:
             data['entities'] = [getattr(e, '_data', e) for e in entities]
-        bot_requests.send_to_conversation(self._service_uri, self._conversation_id, data)
+        return data
 
     def reply(self, text, attachments=[], entities=[], **extras):
         data = {
@@ -103,4 +477,170 @@ class Message:
             data['attachments'] = [getattr(a, '_data', a) for a in attachments]
         if entities:
             data['entities'] = [getattr(e, '_data', e) for e in entities]
-        bot_requests.reply_to_activity(self._service_uri, self._conversation_id, self._activity_id, data)
+        self._send(True, data)
+
+    def send_typing(self):
+        """Shows the user that the bot is typing, without waiting for the send.
+
+        The indicator is sent at once, even while an Outbox is open.
+
+        """
+        return bot_requests.send_in_background(
+            bot_requests.send_to_conversation, self._service_uri, self._conversation_id, self._typing_activity())
+
+    async def send_typing_async(self):
+        """A coroutine that sends the typing indicator with bot_requests_async.
+
+        Unlike send_typing(), it returns once the indicator is sent; run it
+        as a task of its own to go on without waiting.
+
+        """
+        await bot_requests_async.send_to_conversation(self._service_uri, self._conversation_id,
+                                                      self._typing_activity())
+
+    def _typing_activity(self):
+        return {
+            'type': 'typing',
+            'conversation': {'id': self._conversation_id},
+            'from': self.recipient._data,
+            'recipient': self.from_user._data,
+        }
+
+    def _send(self, reply, activity):
+        if self._outbox is not None:
+            self._outbox.append((reply, activity))
+        elif reply:
+            bot_requests.reply_to_activity(self._service_uri, self._conversation_id, self._activity_id, activity)
+        else:
+            bot_requests.send_to_conversation(self._service_uri, self._conversation_id, activity)
+
+    async def _send_async(self, reply, activity):
+        if self._outbox is not None:
+            self._outbox.append((reply, activity))
+        elif reply:
+            await bot_requests_async.reply_to_activity(self._service_uri, self._conversation_id,
+                                                       self._activity_id, activity)
+        else:
+            await bot_requests_async.send_to_conversation(self._service_uri, self._conversation_id, activity)
+
+    def flush_outbox(self):
+        """Sends the held activities, merging each run that can be merged.
+
+        Consecutive posts, or consecutive replies, that differ only in their
+        text, attachments and entities become a single activity, so a turn
+        that posts several messages costs one round trip.
+
+        """
+        if not self._outbox:
+            return
+        held, self._outbox = self._outbox, None
+        try:
+            for reply, activity in _merge_runs(held):
+                self._send(reply, activity)
+        finally:
+            self._outbox = []
+
+    async def flush_outbox_async(self):
+        """A coroutine that does what flush_outbox() does."""
+        if not self._outbox:
+            return
+        held, self._outbox = self._outbox, None
+        try:
+            for reply, activity in _merge_runs(held):
+                await self._send_async(reply, activity)
+        finally:
+            self._outbox = []
+
+
+class StateSession:
+
+    """Defers the state writes of a message and its users for one turn.
+
+    While the session is open, save_data() only marks a scope as dirty.
+    When the session closes without an error, each dirty scope whose data
+    changed since it was loaded is posted exactly once.  Nothing is posted
+    when no data changed, such as when a first-turn conversation completes
+    and its state is cleared again.  Opened with async with, the writes
+    are posted with the stores' coroutines.
+
+    """
+
+    def __init__(self, msg):
+        self._owners = [msg, msg.from_user, msg.recipient]
+
+    def __enter__(self):
+        for owner in self._owners:
+            owner._deferred = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for owner in self._owners:
+            owner._deferred = False
+        if exc_type is None:
+            self.flush()
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        for owner in self._owners:
+            owner._deferred = False
+        if exc_type is None:
+            await self.flush_async()
+        return False
+
+    def flush(self):
+        """Posts every dirty, changed scope now."""
+        for owner in self._owners:
+            owner.flush_data()
+
+    async def flush_async(self):
+        """A coroutine that does what flush() does."""
+        for owner in self._owners:
+            await owner.flush_data_async()
+
+
+class Outbox:
+
+    """Holds the posts and replies of a message for one turn.
+
+    While the outbox is open, Message.post() and Message.reply() only
+    queue their activity.  When it closes without an error, the queue is
+    sent with Message.flush_outbox(), which merges it into as few
+    activities as it can; opened with async with, it is sent with
+    Message.flush_outbox_async().
+
+    """
+
+    def __init__(self, msg):
+        self._msg = msg
+        self._opened = False
+
+    def __enter__(self):
+        # A nested outbox leaves the sending to the outermost one.
+        if self._msg._outbox is None:
+            self._msg._outbox = []
+            self._opened = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._opened:
+            try:
+                if exc_type is None:
+                    self._msg.flush_outbox()
+            finally:
+                self._msg._outbox = None
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self._opened:
+            try:
+                if exc_type is None:
+                    await self._msg.flush_outbox_async()
+            finally:
+                self._msg._outbox = None
+        return False
@@ -0,0 +1,407 @@
+"""Timeouts, retries and circuit breakers for the bot's outbound calls.
+
+Each remote service the bot depends on (LUIS, StackExchange, the Bot
+Framework) is a Dependency with its own timeout, retry policy and
+CircuitBreaker.  Dependency.call() runs a request function:
+
+    r = luis.call(lambda: requests.get(url, timeout=luis.timeout))
+
+Failures that look transient, such as connection errors, timeouts, 5xx
+and 429 responses, are retried with capped exponential backoff and
+jitter.  Every retry must also be paid for from a RetryBudget shared by
+all dependencies, so a widespread outage cannot turn into a retry storm.
+Once a dependency fails repeatedly, its breaker opens and calls fail at
+once with CircuitOpenError until a trial call succeeds again.
+
+Callers that can answer without a dependency catch FAILURES and route
+to a degraded answer instead of holding a worker.
+
+A dependency can also hedge its idempotent calls: when an attempt has
+not answered within a percentile of the dependency's recent latencies,
+a duplicate is sent and whichever answers first is used.  Hedges are
+paid for from a budget of their own, so they add only a small fraction
+of extra load.
+
+Dependency.call_async() does the same for a coroutine function, such as
+an aiohttp request, without blocking the event loop.
+
+"""
+import asyncio
+import collections
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class DependencyError(Exception):
+
+    """Raised when a dependency cannot be called."""
+
+
+class CircuitOpenError(DependencyError):
+
+    """Raised instead of calling a dependency whose circuit is open."""
+
+
+# The exceptions raised when a dependency is unavailable, and those of
+# them that a later attempt might not raise.
+FAILURES = (DependencyError, requests.RequestException)
+_TRANSIENT = (requests.ConnectionError, requests.Timeout)
+if aiohttp is not None:
+    FAILURES += (aiohttp.ClientError, asyncio.TimeoutError)
+    _TRANSIENT += (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+# Hedging defaults, for the dependencies that allow it.  The percentile
+# of recent latencies to wait before hedging, or None to never hedge, and
+# the most hedges to send per call.
+try:
+    HEDGE_PERCENTILE = float(os.environ['HEDGE_PERCENTILE']) if os.environ.get('HEDGE_PERCENTILE') else None
+    HEDGE_RATIO = float(os.environ.get('HEDGE_RATIO', '0.05'))
+except ValueError:
+    HEDGE_PERCENTILE = None
+    HEDGE_RATIO = 0.05
+# Latencies needed before a percentile is trusted.
+_MIN_LATENCY_SAMPLES = 20
+# The most first attempts of hedged calls in flight at once.  Each has a
+# thread of the attempt executor, so none waits behind a slow one; beyond
+# the limit, calls are made on the caller's thread without a hedge.
+_MAX_HEDGED_CALLS = 64
+_attempt_executor = ThreadPoolExecutor(max_workers=_MAX_HEDGED_CALLS)
+_attempt_slots = threading.BoundedSemaphore(_MAX_HEDGED_CALLS)
+# Runs the hedges, which their budget keeps to a few.
+_hedge_executor = ThreadPoolExecutor(max_workers=16)
+
+
+def is_failed_response(response):
+    """True for a requests or aiohttp response that says the service is unhealthy or overloaded."""
+    status = getattr(response, 'status_code', None) or response.status
+    return status >= 500 or status == 429
+
+def is_transient(exc):
+    """True for an exception that a later attempt might not raise."""
+    return isinstance(exc, _TRANSIENT)
+
+def _is_connect_error(exc):
+    """True when a request failed before it was sent."""
+    if aiohttp is not None and isinstance(exc, aiohttp.ClientConnectorError):
+        return True
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.ConnectionError) and exc.args:
+        # requests wraps urllib3's error, whose reason tells a connection
+        # that was refused or not resolved from one lost mid-request.
+        reason = getattr(exc.args[0], 'reason', exc.args[0])
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class RetryBudget:
+
+    """Limits retries to a fraction of all calls, plus a small steady rate.
+
+    Each call deposits ratio of a retry into the budget, and each retry
+    withdraws a whole one.  min_per_second retries are always allowed, so
+    a quiet process can still retry.
+
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, max_tokens=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """Records a call."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Takes one retry from the budget; False when it is spent."""
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated_at) * self.min_per_second)
+        self._updated_at = now
+
+
+class LatencyTracker:
+
+    """Keeps the most recent latencies of a dependency, in seconds."""
+
+    def __init__(self, size=200):
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p):
+        """Returns the p-th percentile latency, or None while there are too few samples."""
+        with self._lock:
+            if len(self._samples) < _MIN_LATENCY_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class CircuitBreaker:
+
+    """Fails fast after failure_threshold failures in a row.
+
+    The circuit stays open for reset_timeout seconds, then lets a single
+    trial call through.  The trial's success closes the circuit again;
+    its failure reopens it.
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True when a call may be made now."""
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                # Let one trial call through.
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+
+
+class Dependency:
+
+    """The timeout, retry policy and circuit breaker of one remote service."""
+
+    def __init__(self, name, timeout=(3.05, 10), retries=2, backoff=0.1, max_backoff=2.0,
+                 breaker=None, budget=None, hedge_percentile=None, hedge_ratio=HEDGE_RATIO):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.budget = budget or retry_budget
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = RetryBudget(ratio=hedge_ratio, min_per_second=0, max_tokens=1)
+        self.latencies = LatencyTracker()
+        self.hedges = 0
+
+    def call(self, f, idempotent=True, retry=True, is_failure=is_failed_response):
+        """Returns f(), retrying transient failures.
+
+        f makes one request and returns its response.  A response for which
+        is_failure is True counts as a failure; it is closed and retried,
+        and if every attempt fails the last response is returned for the
+        caller to handle.  Calls that are not idempotent are only retried when the
+        connection could not be made, so the request was never sent.
+
+        Idempotent calls are hedged when hedge_percentile is set.
+
+        Raises CircuitOpenError without calling f while the circuit is open.
+
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError("{} is unavailable; its circuit is open.".format(self.name))
+            self.budget.deposit()
+            try:
+                result = self._attempt(f, idempotent)
+            except Exception as e:
+                if not is_transient(e):
+                    # The service answered; the error is the caller's.
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                if not self._should_retry(attempt, retry, idempotent or _is_connect_error(e)):
+                    raise
+            else:
+                if is_failure is None or not is_failure(result):
+                    self.breaker.record_success()
+                    return result
+                self.breaker.record_failure()
+                if not self._should_retry(attempt, retry, idempotent):
+                    return result
+                # A streamed response holds its connection until closed.
+                _close(result)
+            time.sleep(self._delay(attempt))
+            attempt += 1
+
+    async def call_async(self, f, idempotent=True, retry=True, is_failure=is_failed_response):
+        """Returns await f(), as call() returns f().
+
+        f is a coroutine function that makes one request.  Retries, the
+        circuit breaker, the retry budget and hedging work as for call(),
+        but waits are made on the event loop.
+
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError("{} is unavailable; its circuit is open.".format(self.name))
+            self.budget.deposit()
+            try:
+                result = await self._attempt_async(f, idempotent)
+            except Exception as e:
+                if not is_transient(e):
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                if not self._should_retry(attempt, retry, idempotent or _is_connect_error(e)):
+                    raise
+            else:
+                if is_failure is None or not is_failure(result):
+                    self.breaker.record_success()
+                    return result
+                self.breaker.record_failure()
+                if not self._should_retry(attempt, retry, idempotent):
+                    return result
+            await asyncio.sleep(self._delay(attempt))
+            attempt += 1
+
+    def _attempt(self, f, idempotent):
+        """Returns f(), or the result of a hedged duplicate if that answers first."""
+        delay = self.latencies.percentile(self.hedge_percentile) if idempotent and self.hedge_percentile else None
+        self.hedge_budget.deposit()
+        if delay is None or not _attempt_slots.acquire(blocking=False):
+            return self._timed(f)
+
+        first = _attempt_executor.submit(self._timed, f)
+        first.add_done_callback(lambda _: _attempt_slots.release())
+        done, _ = wait([first], timeout=delay)
+        if done or not self.hedge_budget.withdraw():
+            return first.result()
+        self.hedges += 1
+        attempts = [first, _hedge_executor.submit(self._timed, f)]
+        pending = attempts
+        while True:
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            answered = [future for future in done if future.exception() is None]
+            if answered or not not_done:
+                winner = (answered or list(done))[0]
+                # The slower attempt is left to finish on its own, and its response closed.
+                for future in attempts:
+                    if future is not winner:
+                        future.add_done_callback(_close_result)
+                return winner.result()
+            pending = list(not_done)
+
+    async def _attempt_async(self, f, idempotent):
+        """Returns await f(), or the result of a hedged duplicate if that answers first."""
+        delay = self.latencies.percentile(self.hedge_percentile) if idempotent and self.hedge_percentile else None
+        self.hedge_budget.deposit()
+        if delay is None:
+            return await self._timed_async(f)
+
+        first = asyncio.ensure_future(self._timed_async(f))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done or not self.hedge_budget.withdraw():
+            return await first
+        self.hedges += 1
+        pending = [first, asyncio.ensure_future(self._timed_async(f))]
+        while True:
+            done, not_done = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            answered = [future for future in done if future.exception() is None]
+            if answered or not not_done:
+                for future in not_done:
+                    future.cancel()
+                return (answered or list(done))[0].result()
+            pending = list(not_done)
+
+    def _timed(self, f):
+        start = time.monotonic()
+        result = f()
+        self.latencies.record(time.monotonic() - start)
+        return result
+
+    async def _timed_async(self, f):
+        start = time.monotonic()
+        result = await f()
+        self.latencies.record(time.monotonic() - start)
+        return result
+
+    def _should_retry(self, attempt, retry, safe):
+        return retry and safe and attempt < self.retries and self.budget.withdraw()
+
+    def _delay(self, attempt):
+        # Full jitter, so retries from many workers do not line up.
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+def _close(response):
+    """Closes a response that will not be used, returning its connection to the pool."""
+    close = getattr(response, 'close', None)
+    if close is not None:
+        close()
+
+def _close_result(future):
+    """Closes the response of a finished attempt that lost to another."""
+    if future.exception() is None:
+        _close(future.result())
+
+
+# The retry budget shared by every dependency.
+retry_budget = RetryBudget()
+
+_dependencies = {}
+_dependencies_lock = threading.Lock()
+
+def dependency(name, **settings):
+    """Returns the Dependency called name, creating it with settings the first time."""
+    with _dependencies_lock:
+        if name not in _dependencies:
+            _dependencies[name] = Dependency(name, **settings)
+        return _dependencies[name]
+
+def states():
+    """Returns a dict of each dependency's name and circuit state."""
+    with _dependencies_lock:
+        return {name: d.breaker.state for name, d in _dependencies.items()}
+
+def hedge_counts():
+    """Returns a dict of each dependency's name and the hedges it has sent."""
+    with _dependencies_lock:
+        return {name: d.hedges for name, d in _dependencies.items()}
@@ -0,0 +1,225 @@
+"""Serves the bot's WSGI app with a pool of threads, in one or more processes.
+
+bottle's wsgiref server handles one request at a time, so every
+conversation waits behind the slowest LUIS or StackExchange call.
+
+run_threaded() serves requests on a bounded pool of threads.  The
+listening socket is only accepted from while a thread is free, so excess
+connections wait in the kernel's backlog rather than in the process.
+
+run_prefork() binds the socket, calls preload() and then forks workers
+that each serve it with their own pool of threads.  Data loaded by
+preload() is shared by the workers until one of them writes to it.  The
+parent restarts workers that die, and passes SIGTERM and SIGINT on to
+them.  Either signal shuts a worker down gracefully: it stops accepting,
+finishes the requests it has, calls on_exit() and exits.
+
+Platforms without os.fork fall back to run_threaded().
+
+run_gevent() serves requests on greenlets instead of threads, at most
+greenlets of them at a time, which suits many slow, I/O-bound
+conversations.  It needs the gevent package, and the standard library
+must already be monkey-patched, as app.py does at startup, so that the
+bot's blocking calls yield to other greenlets.
+
+"""
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+try:
+    import gevent
+    import gevent.pool
+    import gevent.pywsgi
+except ImportError:
+    gevent = None
+
+_DEFAULT_THREADS = 16
+_DEFAULT_GREENLETS = 1000
+# Seconds workers are given to finish their requests before being killed.
+_SHUTDOWN_TIMEOUT = 30
+# Seconds between restarts of a worker that keeps dying.
+_RESTART_DELAY = 1
+
+
+class PooledWSGIServer(WSGIServer):
+
+    """A WSGIServer that handles each request on a pool of threads."""
+
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class=WSGIRequestHandler, threads=_DEFAULT_THREADS):
+        super().__init__(server_address, handler_class)
+        self.threads = threads
+        self._executor = None
+        self._free = None
+
+    def serve_forever(self, poll_interval=0.5):
+        """Serves until shutdown(), then waits for the requests in progress."""
+        # Created here rather than in __init__, so that forked workers
+        # each start their own threads.
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._free = threading.BoundedSemaphore(self.threads)
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def _handle_request_noblock(self):
+        # Only accept a connection once a thread can take it.
+        self._free.acquire()
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            self._free.release()
+            return
+        if self.verify_request(request, client_address):
+            self._executor.submit(self._process, request, client_address)
+        else:
+            self.shutdown_request(request)
+            self._free.release()
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._free.release()
+
+
+def run_threaded(app, host, port, threads=_DEFAULT_THREADS, preload=None, on_exit=None):
+    """Serves app on host:port with threads threads until SIGTERM or SIGINT."""
+    server = _make_server(app, host, port, threads)
+    if preload is not None:
+        preload()
+    print("Serving on http://{}:{}/ with {} threads.".format(host, port, threads))
+    _serve(server, on_exit)
+
+def run_prefork(app, host, port, workers, threads=_DEFAULT_THREADS, preload=None,
+                post_fork=None, on_exit=None):
+    """Serves app on host:port from workers processes of threads threads each.
+
+    preload() is called once, before forking; post_fork() is called in
+    each worker after it is forked, to start anything that runs threads.
+
+    """
+    if not hasattr(os, 'fork'):
+        print("os.fork is not available; serving from one process.")
+        if post_fork is not None:
+            post_fork()
+        run_threaded(app, host, port, threads, preload, on_exit)
+        return
+
+    server = _make_server(app, host, port, threads)
+    if preload is not None:
+        preload()
+    print("Serving on http://{}:{}/ with {} workers of {} threads.".format(host, port, workers, threads))
+
+    children = set()
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # The worker.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 1
+            try:
+                if post_fork is not None:
+                    post_fork()
+                _serve(server, on_exit)
+                status = 0
+            except BaseException:
+                sys.excepthook(*sys.exc_info())
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        children.add(pid)
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(time.monotonic() + _SHUTDOWN_TIMEOUT)
+        for pid in list(children):
+            _kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if stopping and time.monotonic() > stopping[0]:
+                for pid in list(children):
+                    _kill(pid, signal.SIGKILL)
+            time.sleep(0.1)
+            continue
+        children.discard(pid)
+        if not stopping:
+            print("Worker {} exited with status {}; restarting it.".format(pid, status))
+            time.sleep(_RESTART_DELAY)
+            spawn()
+    server.server_close()
+
+def run_gevent(app, host, port, greenlets=_DEFAULT_GREENLETS, preload=None, on_exit=None):
+    """Serves app on host:port with up to greenlets greenlets until SIGTERM or SIGINT."""
+    if gevent is None:
+        raise RuntimeError("The gevent server requires the gevent package.")
+    server = gevent.pywsgi.WSGIServer((host, port), app, spawn=gevent.pool.Pool(greenlets))
+    if preload is not None:
+        preload()
+
+    def stop():
+        # stop() stops accepting, then waits for the requests in progress.
+        gevent.spawn(server.stop, _SHUTDOWN_TIMEOUT)
+
+    # Older gevent releases call signal_handler signal.
+    signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    signal_handler(signal.SIGTERM, stop)
+    signal_handler(signal.SIGINT, stop)
+    print("Serving on http://{}:{}/ with up to {} greenlets.".format(host, port, greenlets))
+    try:
+        server.serve_forever()
+    finally:
+        if on_exit is not None:
+            on_exit()
+
+
+def _make_server(app, host, port, threads):
+    server = PooledWSGIServer((host, port), threads=threads)
+    # Forked workers share the socket, so another may take a connection
+    # between select() and accept().
+    server.socket.setblocking(False)
+    server.set_app(app)
+    return server
+
+def _serve(server, on_exit):
+    """Serves until SIGTERM or SIGINT, then shuts down gracefully."""
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it cannot be
+        # called from the thread that is serving.
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if on_exit is not None:
+            on_exit()
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
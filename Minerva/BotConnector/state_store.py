@@ -0,0 +1,666 @@
+"""Storage backends for bot state.
+
+Message and User read and write their state through the store returned by
+get_store().  The default store is the remote Bot Framework state service;
+the local stores keep hot conversation state next to the workers.  Every
+store returns state in the same shape as the service, a dict with 'data'
+and 'eTag' keys, and rejects writes whose eTag is stale.
+
+Each store also has coroutine variants of get_many, set and delete for
+the asyncio pipeline.  The state service store makes its calls through
+bot_requests_async; the others run their blocking calls on the event
+loop's default executor.
+
+"""
+import abc
+import asyncio
+import collections
+import copy
+import json
+import socket
+import sqlite3
+import threading
+import time
+from urllib import parse
+
+import bot_requests
+import bot_requests_async
+
+# The three scopes of the Bot Framework state service.
+USER = 'user'
+CONVERSATION = 'conversation'
+PRIVATE_CONVERSATION = 'private'
+# Conversation state kept apart from its data, by the stores that have separate_snapshots.
+SNAPSHOT = 'snapshot'
+
+StateKey = collections.namedtuple('StateKey', ['scope', 'state_uri', 'channel_id', 'conversation_id', 'user_id'])
+
+
+def user_key(state_uri, channel_id, user_id):
+    return StateKey(USER, state_uri, channel_id, None, user_id)
+
+def conversation_key(state_uri, channel_id, conversation_id):
+    return StateKey(CONVERSATION, state_uri, channel_id, conversation_id, None)
+
+def private_conversation_key(state_uri, channel_id, conversation_id, user_id):
+    return StateKey(PRIVATE_CONVERSATION, state_uri, channel_id, conversation_id, user_id)
+
+def snapshot_key(state_uri, channel_id, conversation_id):
+    return StateKey(SNAPSHOT, state_uri, channel_id, conversation_id, None)
+
+
+class StateConflictError(Exception):
+
+    """Raised when a write's eTag does not match the stored state."""
+
+
+#region Stores
+
+class StateStore(abc.ABC):
+
+    """An interface-like abstract class for bot state storage."""
+
+    # True when the store keeps snapshot keys, see snapshot_key().  A store
+    # whose every read is a remote round trip leaves this False, and
+    # Message then keeps snapshot data inside the conversation's data.
+    separate_snapshots = True
+
+    @abc.abstractmethod
+    def get(self, key, etag=None):
+        """Returns a dict with the 'data' and 'eTag' stored for key.
+
+        When etag is given and is still the stored eTag, returns None
+        instead, so that unchanged state need not be transferred.
+
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, key, etag_and_data):
+        """Stores etag_and_data['data'] for key and returns the new 'eTag'."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """Removes all state for key.
+
+        For a user key, all of the user's state in the channel is removed.
+
+        """
+        raise NotImplementedError
+
+    def get_many(self, keys, etags=None):
+        """Returns the state for each key, in the same order as keys.
+
+        Etags, if given, holds the eTag or None for each key, with the
+        same meaning as for get.
+
+        """
+        etags = etags or [None] * len(keys)
+        return [self.get(key, etag) for key, etag in zip(keys, etags)]
+
+    def close(self):
+        """Releases any resources held by the store."""
+        pass
+
+    async def get_many_async(self, keys, etags=None):
+        """A coroutine that returns get_many(keys, etags)."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_many, keys, etags)
+
+    async def set_async(self, key, etag_and_data):
+        """A coroutine that returns set(key, etag_and_data)."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.set, key, etag_and_data)
+
+    async def delete_async(self, key):
+        """A coroutine that calls delete(key)."""
+        await asyncio.get_running_loop().run_in_executor(None, self.delete, key)
+
+
+class BotStateStore(StateStore):
+
+    """Stores state in the remote Bot Framework state service.
+
+    The service only has the user, conversation and private conversation
+    scopes, so it does not keep snapshot keys.
+
+    """
+
+    separate_snapshots = False
+
+    def get(self, key, etag=None):
+        return bot_requests.fetch_concurrently([self._get_request(key, etag)])[0]
+
+    def get_many(self, keys, etags=None):
+        etags = etags or [None] * len(keys)
+        return bot_requests.fetch_concurrently([self._get_request(key, etag) for key, etag in zip(keys, etags)])
+
+    def set(self, key, etag_and_data):
+        _check_service_scope(key)
+        if key.scope == USER:
+            return bot_requests.set_user_data(key.state_uri, key.channel_id, key.user_id, etag_and_data)
+        elif key.scope == CONVERSATION:
+            return bot_requests.set_conversation_data(key.state_uri, key.channel_id, key.conversation_id, etag_and_data)
+        return bot_requests.set_private_conversation_data(key.state_uri, key.channel_id, key.conversation_id,
+                                                          key.user_id, etag_and_data)
+
+    def delete(self, key):
+        if key.scope != USER:
+            raise ValueError("The state service can only delete state by user, not by {}.".format(key.scope))
+        bot_requests.delete_state_for_user(key.state_uri, key.channel_id, key.user_id)
+
+    def _get_request(self, key, etag, requests=bot_requests):
+        """Returns the (function, args) pair that fetches key with requests' functions."""
+        _check_service_scope(key)
+        if key.scope == USER:
+            return requests.get_user_data, (key.state_uri, key.channel_id, key.user_id, etag)
+        elif key.scope == CONVERSATION:
+            return requests.get_conversation_data, (key.state_uri, key.channel_id, key.conversation_id, etag)
+        return requests.get_private_conversation_data, (key.state_uri, key.channel_id,
+                                                        key.conversation_id, key.user_id, etag)
+
+    async def get_many_async(self, keys, etags=None):
+        etags = etags or [None] * len(keys)
+        return await bot_requests_async.fetch_concurrently(
+            [self._get_request(key, etag, bot_requests_async) for key, etag in zip(keys, etags)])
+
+    async def set_async(self, key, etag_and_data):
+        _check_service_scope(key)
+        if key.scope == USER:
+            return await bot_requests_async.set_user_data(key.state_uri, key.channel_id, key.user_id, etag_and_data)
+        elif key.scope == CONVERSATION:
+            return await bot_requests_async.set_conversation_data(key.state_uri, key.channel_id,
+                                                                  key.conversation_id, etag_and_data)
+        return await bot_requests_async.set_private_conversation_data(key.state_uri, key.channel_id, key.conversation_id,
+                                                                      key.user_id, etag_and_data)
+
+    async def delete_async(self, key):
+        if key.scope != USER:
+            raise ValueError("The state service can only delete state by user, not by {}.".format(key.scope))
+        await bot_requests_async.delete_state_for_user(key.state_uri, key.channel_id, key.user_id)
+
+
+def _check_service_scope(key):
+    if key.scope not in (USER, CONVERSATION, PRIVATE_CONVERSATION):
+        raise ValueError("The state service has no {} scope.".format(key.scope))
+
+
+class _LocalStateStore(StateStore):
+
+    """A base class for stores that keep state as versioned JSON text.
+
+    Derived classes only read and write (version, text) records; this
+    class handles the eTag checks and the record format.  Keys do not
+    include the state uri, since a local store serves a single bot.
+
+    """
+
+    def _record_key(self, key):
+        parts = [key.scope, key.channel_id, key.conversation_id or '', key.user_id or '']
+        return ':'.join(parts)
+
+    def _user_records(self, key):
+        """Returns the parts of the record keys that hold any state for key's user.
+
+        These are the user's own record key, and the prefix and suffix
+        shared by the user's private conversation records.
+
+        """
+        return (self._record_key(user_key(None, key.channel_id, key.user_id)),
+                ':'.join([PRIVATE_CONVERSATION, key.channel_id, '']),
+                ':' + (key.user_id or ''))
+
+    def _to_state(self, record, etag=None):
+        if record is None:
+            return {}
+        version, text = record
+        if etag == str(version):
+            return None
+        return {'data': json.loads(text), 'eTag': str(version)}
+
+    def _check_etag(self, etag, record):
+        if etag in (None, '*'):
+            return
+        current = str(record[0]) if record else None
+        if etag != current:
+            raise StateConflictError("The state has been changed since it was read (eTag {} is not {}).".format(etag, current))
+
+    def _next_record(self, etag_and_data, record):
+        self._check_etag(etag_and_data.get('eTag'), record)
+        version = record[0] + 1 if record else 1
+        return version, json.dumps(etag_and_data.get('data'))
+
+
+class MemoryStateStore(_LocalStateStore):
+
+    """Keeps state in a dict, for a single process."""
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, etag=None):
+        with self._lock:
+            record = self._records.get(self._record_key(key))
+        return self._to_state(record, etag)
+
+    def set(self, key, etag_and_data):
+        record_key = self._record_key(key)
+        with self._lock:
+            record = self._next_record(etag_and_data, self._records.get(record_key))
+            self._records[record_key] = record
+        return {'eTag': str(record[0])}
+
+    def delete(self, key):
+        with self._lock:
+            if key.scope == USER:
+                user_record, prefix, suffix = self._user_records(key)
+                doomed = [k for k in self._records
+                          if k == user_record or (k.startswith(prefix) and k.endswith(suffix))]
+            else:
+                doomed = [self._record_key(key)]
+            for k in doomed:
+                self._records.pop(k, None)
+
+
+class SqliteStateStore(_LocalStateStore):
+
+    """Keeps state in a SQLite database in write-ahead-log mode.
+
+    WAL mode lets readers run alongside a writer, so every worker process
+    on a box can share one database file.  Each thread uses its own
+    connection.
+
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS state ('
+                                   'key TEXT PRIMARY KEY, version INTEGER NOT NULL, data TEXT NOT NULL)')
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def get(self, key, etag=None):
+        row = self._connection().execute('SELECT version, data FROM state WHERE key = ?',
+                                          (self._record_key(key),)).fetchone()
+        return self._to_state(row, etag)
+
+    def set(self, key, etag_and_data):
+        record_key = self._record_key(key)
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT version, data FROM state WHERE key = ?', (record_key,)).fetchone()
+            version, text = self._next_record(etag_and_data, row)
+            db.execute('INSERT OR REPLACE INTO state (key, version, data) VALUES (?, ?, ?)',
+                       (record_key, version, text))
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return {'eTag': str(version)}
+
+    def delete(self, key):
+        db = self._connection()
+        if key.scope == USER:
+            user_record, prefix, suffix = self._user_records(key)
+            db.execute('DELETE FROM state WHERE key = ? OR (substr(key, 1, ?) = ? AND substr(key, -?) = ?)',
+                       (user_record, len(prefix), prefix, len(suffix), suffix))
+        else:
+            db.execute('DELETE FROM state WHERE key = ?', (self._record_key(key),))
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+class RedisStateStore(_LocalStateStore):
+
+    """Keeps state in any server that speaks the Redis protocol (RESP).
+
+    Writes use WATCH/MULTI/EXEC so that eTag checks are atomic.  Only a
+    handful of commands are used, so a local stand-in such as a small
+    RESP server works as well as Redis itself.  Each thread uses its own
+    connection.
+
+    """
+
+    _PREFIX = 'botstate:'
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _RespConnection(self.host, self.port, self.timeout)
+            if self.password:
+                conn.execute('AUTH', self.password)
+            if self.db:
+                conn.execute('SELECT', self.db)
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, *args):
+        try:
+            return self._connection().execute(*args)
+        except (OSError, ConnectionError):
+            # Drop the broken connection so the next call reconnects.
+            self.close()
+            raise
+
+    def _load(self, redis_key):
+        value = self._execute('GET', redis_key)
+        if value is None:
+            return None
+        record = json.loads(value.decode())
+        return record['version'], record['data']
+
+    def get(self, key, etag=None):
+        return self._to_state(self._load(self._PREFIX + self._record_key(key)), etag)
+
+    def set(self, key, etag_and_data):
+        redis_key = self._PREFIX + self._record_key(key)
+        self._execute('WATCH', redis_key)
+        try:
+            version, text = self._next_record(etag_and_data, self._load(redis_key))
+        except Exception:
+            self._execute('UNWATCH')
+            raise
+        self._execute('MULTI')
+        self._execute('SET', redis_key, json.dumps({'version': version, 'data': text}))
+        if self._execute('EXEC') is None:
+            raise StateConflictError("The state for {} was changed by another writer.".format(redis_key))
+        return {'eTag': str(version)}
+
+    def delete(self, key):
+        if key.scope != USER:
+            self._execute('DEL', self._PREFIX + self._record_key(key))
+            return
+        user_record, prefix, suffix = self._user_records(key)
+        pattern = _glob_escape(self._PREFIX + prefix) + '*' + _glob_escape(suffix)
+        doomed = [self._PREFIX + user_record]
+        cursor = b'0'
+        while True:
+            cursor, found = self._execute('SCAN', cursor, 'MATCH', pattern)
+            doomed.extend(found)
+            if cursor == b'0':
+                break
+        self._execute('DEL', *doomed)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# Returned by CachingStateStore._resolve when a key must be read again.
+_REREAD = object()
+
+
+class CachingStateStore(StateStore):
+
+    """Keeps a process-local, eTag-validated copy of state from another store.
+
+    Every read of a cached key is a conditional read against the wrapped
+    store, so state that has not changed is not transferred or parsed
+    again, while changes made by other processes are still seen.  Writes
+    go through to the wrapped store and refresh the cached copy.  Entries
+    expire ttl seconds after they were last validated, and the least
+    recently used entries are dropped beyond max_entries.
+
+    """
+
+    def __init__(self, store, ttl=300, max_entries=1000, scopes=(CONVERSATION, PRIVATE_CONVERSATION, SNAPSHOT)):
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.scopes = scopes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def separate_snapshots(self):
+        return self.store.separate_snapshots
+
+    def _cache_key(self, key):
+        return key.scope, key.channel_id, key.conversation_id, key.user_id
+
+    def _cached_etag(self, key):
+        """Returns the eTag of key's live entry, or None."""
+        if key.scope not in self.scopes:
+            return None
+        with self._lock:
+            entry = self._entries.get(self._cache_key(key))
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[self._cache_key(key)]
+                return None
+            return entry[1]
+
+    def _remember(self, key, etag, data):
+        if key.scope not in self.scopes or not etag or etag == '*':
+            return
+        cache_key = self._cache_key(key)
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + self.ttl, etag, copy.deepcopy(data))
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _forget(self, key):
+        with self._lock:
+            if key.scope == USER:
+                doomed = [k for k in self._entries if k[1] == key.channel_id and k[3] == key.user_id]
+            else:
+                doomed = [self._cache_key(key)]
+            for k in doomed:
+                self._entries.pop(k, None)
+
+    def _resolve(self, key, cached_etag, etag, state):
+        """Returns the state for key given the wrapped store's answer."""
+        if state is None and cached_etag is not None:
+            # Not modified since it was cached.
+            self.hits += 1
+            with self._lock:
+                entry = self._entries.get(self._cache_key(key))
+                if entry is not None:
+                    self._entries[self._cache_key(key)] = (time.monotonic() + self.ttl,) + entry[1:]
+                    self._entries.move_to_end(self._cache_key(key))
+                    if etag == cached_etag:
+                        return None
+                    return {'data': copy.deepcopy(entry[2]), 'eTag': cached_etag}
+            # Evicted while the request was in flight, so read it again.
+            return _REREAD
+        if state is not None:
+            self.misses += 1
+            self._remember(key, state.get('eTag'), state.get('data'))
+        return state
+
+    def get(self, key, etag=None):
+        return self.get_many([key], [etag])[0]
+
+    def get_many(self, keys, etags=None):
+        etags = etags or [None] * len(keys)
+        cached_etags = [self._cached_etag(key) for key in keys]
+        # Ask the wrapped store for changes since the cached copy, if there is one.
+        conditions = [cached or etag for cached, etag in zip(cached_etags, etags)]
+        states = self.store.get_many(keys, conditions)
+        resolved = [self._resolve(key, cached, etag, state)
+                    for key, cached, etag, state in zip(keys, cached_etags, etags, states)]
+        return [self.store.get(key, etag) if state is _REREAD else state
+                for key, etag, state in zip(keys, etags, resolved)]
+
+    def set(self, key, etag_and_data):
+        try:
+            result = self.store.set(key, etag_and_data)
+        except Exception:
+            self._forget(key)
+            raise
+        return self._written(key, etag_and_data, result)
+
+    def _written(self, key, etag_and_data, result):
+        """Caches what was written to key, and returns the wrapped store's result."""
+        etag = (result or {}).get('eTag')
+        if etag:
+            self._remember(key, etag, etag_and_data.get('data'))
+        else:
+            self._forget(key)
+        return result
+
+    def delete(self, key):
+        self._forget(key)
+        self.store.delete(key)
+
+    async def get_many_async(self, keys, etags=None):
+        etags = etags or [None] * len(keys)
+        cached_etags = [self._cached_etag(key) for key in keys]
+        conditions = [cached or etag for cached, etag in zip(cached_etags, etags)]
+        states = await self.store.get_many_async(keys, conditions)
+        resolved = [self._resolve(key, cached, etag, state)
+                    for key, cached, etag, state in zip(keys, cached_etags, etags, states)]
+        for i, state in enumerate(resolved):
+            if state is _REREAD:
+                resolved[i] = (await self.store.get_many_async([keys[i]], [etags[i]]))[0]
+        return resolved
+
+    async def set_async(self, key, etag_and_data):
+        try:
+            result = await self.store.set_async(key, etag_and_data)
+        except Exception:
+            self._forget(key)
+            raise
+        return self._written(key, etag_and_data, result)
+
+    async def delete_async(self, key):
+        self._forget(key)
+        await self.store.delete_async(key)
+
+    def close(self):
+        with self._lock:
+            self._entries.clear()
+        self.store.close()
+
+
+def _glob_escape(text):
+    """Escapes the characters that are special in a Redis MATCH pattern."""
+    return ''.join('\\' + c if c in '*?[]\\' else c for c in text)
+
+
+class _RespConnection:
+
+    """A minimal blocking Redis protocol client."""
+
+    def __init__(self, host, port, timeout):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._file = self._sock.makefile('rb')
+
+    def execute(self, *args):
+        """Sends a command and returns its parsed reply."""
+        parts = [b'*' + str(len(args)).encode() + b'\r\n']
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$' + str(len(arg)).encode() + b'\r\n' + arg + b'\r\n')
+        self._sock.sendall(b''.join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("The Redis server closed the connection.")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        elif kind == b'-':
+            raise Exception(rest.decode())
+        elif kind == b':':
+            return int(rest)
+        elif kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            value = self._file.read(length + 2)
+            return value[:-2]
+        elif kind == b'*':
+            count = int(rest)
+            if count < 0:
+                return None
+            return [self._read_reply() for _ in range(count)]
+        raise ConnectionError("Unexpected reply from the Redis server: {!r}".format(line))
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+#endregion
+
+#region Configuration
+
+_store = BotStateStore()
+
+def get_store():
+    """Returns the store that Message and User use for state."""
+    return _store
+
+def set_store(store):
+    """Replaces the store that Message and User use for state."""
+    global _store
+    _store = store
+
+def from_config(spec, cache_ttl=0):
+    """Creates a store from a configuration string.
+
+    The string is one of:
+        botstate                    - the remote Bot Framework state service
+        memory                      - a process-local dict
+        sqlite:///path/to/state.db  - a SQLite database in WAL mode
+        redis://[:password@]host[:port][/db]  - a Redis protocol server
+
+    When cache_ttl is positive, conversation, private conversation and
+    snapshot state from any store other than memory is cached locally for
+    that many seconds, see CachingStateStore.
+
+    """
+    spec = (spec or 'botstate').strip()
+    if spec.lower() == 'memory':
+        return MemoryStateStore()
+    store = _store_from_spec(spec)
+    if cache_ttl > 0:
+        store = CachingStateStore(store, ttl=cache_ttl)
+    return store
+
+def _store_from_spec(spec):
+    if spec.lower() == 'botstate':
+        return BotStateStore()
+
+    url = parse.urlparse(spec)
+    if url.scheme == 'sqlite':
+        path = url.netloc + url.path
+        # sqlite:///relative.db and sqlite:////absolute.db, as in SQLAlchemy.
+        return SqliteStateStore(path[1:] if path.startswith('/') else path)
+    if url.scheme == 'redis':
+        db = int(url.path.strip('/') or 0)
+        return RedisStateStore(url.hostname or 'localhost', url.port or 6379, db, url.password)
+    raise ValueError("Unknown state store: {}".format(spec))
+
+#endregion
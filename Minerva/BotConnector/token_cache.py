@@ -0,0 +1,127 @@
+"""A token cache shared by every worker process on the machine.
+
+Tokens are kept in a small JSON file with their expiry time, written
+atomically and readable only by the owner where the platform allows.  A
+separate lock file, locked with fcntl on POSIX and msvcrt on Windows,
+makes sure only one process fetches a new token at a time; the others
+wait and then read the token it wrote.
+
+The file should be in a directory that only this user can write to.
+Where the platform has file owners, a token file or lock file that
+belongs to another user, or that others can write to, is not trusted:
+its token is ignored, and its lock raises PermissionError.
+
+"""
+import contextlib
+import json
+import os
+import stat
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class FileTokenCache:
+
+    """A token, and the epoch time it expires at, kept in a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock_path = path + '.lock'
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Holds the cache's lock file exclusively, across processes."""
+        fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT | _O_NOFOLLOW, 0o600)
+        try:
+            if not _is_trusted(fd):
+                raise PermissionError("The token cache lock {} is not this user's own.".format(self._lock_path))
+            _lock_file(fd)
+            try:
+                yield self
+            finally:
+                _unlock_file(fd)
+        finally:
+            os.close(fd)
+
+    def read(self):
+        """Returns (token, expires_at), or (None, 0) when there is no usable token."""
+        try:
+            fd = os.open(self.path, os.O_RDONLY | _O_NOFOLLOW)
+            with os.fdopen(fd, encoding='utf-8') as f:
+                if not _is_trusted(fd):
+                    return None, 0
+                data = json.load(f)
+            return data['token'], float(data['expires_at'])
+        except (OSError, ValueError, LookupError, TypeError):
+            return None, 0
+
+    def write(self, token, expires_at):
+        """Replaces the cached token."""
+        directory = os.path.dirname(self.path) or '.'
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.token')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'token': token, 'expires_at': expires_at}, f)
+            os.replace(temp_path, self.path)
+        except Exception:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
+
+    def get_or_refresh(self, fetch, min_remaining=0):
+        """Returns (token, expires_at), fetching a new token only if needed.
+
+        A cached token is used while it has more than min_remaining seconds
+        left.  Otherwise fetch() is called, under the lock, and must return
+        (token, expires_in); its result is cached for the other processes.
+
+        """
+        token, expires_at = self.read()
+        if token is not None and expires_at - time.time() > min_remaining:
+            return token, expires_at
+        with self.lock():
+            # Another process may have refreshed while this one waited.
+            token, expires_at = self.read()
+            if token is not None and expires_at - time.time() > min_remaining:
+                return token, expires_at
+            token, expires_in = fetch()
+            expires_at = time.time() + expires_in
+            self.write(token, expires_at)
+            return token, expires_at
+
+
+# Opening a cache file never follows a symlink, where the platform allows.
+_O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+def _is_trusted(fd):
+    """True when the open file fd belongs to this user and no one else can write to it."""
+    if not hasattr(os, 'getuid'):
+        return True
+    info = os.fstat(fd)
+    return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _lock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            # Blocks for about ten seconds before raising.
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+def _unlock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
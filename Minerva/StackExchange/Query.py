@@ -3,11 +3,19 @@ import json
 import functools
 import re
 import html
+import threading
+import collections
 from urllib import parse
 from enum import Enum, unique
 
+import bot_requests_async
+import resilience
+
 _MAX_TAGS = 5    # Per the stack exchange API.
 _MAX_PAGE_SIZE = 100
+_RESULT_CACHE_SIZE = 500    # Full question items kept for rehydrating compact results.
+_stackexchange = resilience.dependency('stackexchange', timeout=(3.05, 10),
+                                        hedge_percentile=resilience.HEDGE_PERCENTILE)
 
 
 def trim_non_alpha(word):
@@ -149,9 +157,17 @@ class StackExchangeQuery:
 
     def initiate(self):
         """Actually sends the request."""
-        content = requests.get(self.build_full_url())
+        content = _stackexchange.call(lambda: requests.get(self.build_full_url(), timeout=_stackexchange.timeout))
+        content.raise_for_status()
         self.response = StackExchangeResponse(content)
 
+    async def initiate_async(self):
+        """A coroutine that does what initiate() does."""
+        content = await _stackexchange.call_async(
+            lambda: bot_requests_async.fetch(self.build_full_url(), _stackexchange.timeout))
+        content.raise_for_status()
+        self.response = StackExchangeResponse(content, json=await content.json())
+
 
 class StackExchangeQueryString:
 
@@ -351,6 +367,21 @@ class StackExchangeResponse:
         for q in self._json['items']:
             self.results.append(QuestionResult(q))
         self.result_count = len(self.results)
+        # Compact results rehydrate together, with at most one request.
+        for q, result in zip(self._json['items'], self.results):
+            if result.is_compact():
+                result._group = self.results
+            else:
+                result_cache.put(q)
+
+    @classmethod
+    def from_compact(cls, compact):
+        """Rebuilds a response from the output of compact()."""
+        return cls(None, json=compact)
+
+    def compact(self):
+        """Returns a small serializable form holding only ids, titles, links and scores."""
+        return {'items': [result.compact() for result in self.results]}
 
     def __iter__(self):
         for result in self.results:
@@ -390,21 +421,69 @@ class BaseStackExchangeResult:
 
 class QuestionResult(BaseStackExchangeResult):
 
-    """Represents a question type result."""
+    """Represents a question type result.
+
+    A result built from compact() output only has its id, title, link and
+    score.  The remaining fields are filled in from the result cache, or
+    fetched again from StackExchange, the first time one is used.
+
+    """
+
+    # Fields that a compact result leaves out.
+    _FULL_FIELDS = ('answer_count', 'is_answered', 'tags', 'body')
 
     def __init__(self, json):
         self._json = json
+        self._group = [self]
 
         self.title = html.unescape(json['title'])
-        self.answer_count = json['answer_count']
-        self.is_answered = json['is_answered']
         self.link = json['link']
         self.question_id = json['question_id']
-        self.tags = json['tags']
+        if 'answer_count' in json:
+            self.answer_count = json['answer_count']
+        if 'is_answered' in json:
+            self.is_answered = json['is_answered']
+        if 'tags' in json:
+            self.tags = json['tags']
         if 'body' in json:
             self.body =  html.unescape(json['body'])
         if 'combined_score' in json:
             self.combined_score = json['combined_score']
+
+    def __getattr__(self, attr):
+        if attr in QuestionResult._FULL_FIELDS and self.is_compact():
+            rehydrate_results(self._group)
+            if attr in self.__dict__:
+                return self.__dict__[attr]
+        return super().__getattr__(attr)
+
+    @classmethod
+    def from_compact(cls, compact):
+        """Rebuilds a result from the output of compact()."""
+        return cls(compact)
+
+    def is_compact(self):
+        """True when the result's full fields have not been loaded."""
+        return 'tags' not in self._json
+
+    def compact(self):
+        """Returns a small serializable form holding only the id, title, link and score."""
+        compact = {
+            'question_id': self.question_id,
+            'title': self._json['title'],
+            'link': self.link,
+        }
+        # Not hasattr, which __getattr__ answers with None for results never scored.
+        if 'combined_score' in self.__dict__:
+            compact['combined_score'] = self.combined_score
+        return compact
+
+    def _fill(self, full_json):
+        """Loads the full fields from a full question item."""
+        json = dict(full_json)
+        json.update(self._json)
+        json['body'] = full_json.get('body', '')
+        self.__init__(json)
             
     def score_on_query(self, query, filter_out):
         """Scores this result based on string matching."""
@@ -447,6 +526,74 @@ class QuestionResult(BaseStackExchangeResult):
         return self._json
 
 
+class ResultCache:
+
+    """A bounded, thread-safe cache of full question items by question id."""
+
+    def __init__(self, max_entries=_RESULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        with self._lock:
+            self._items[item['question_id']] = item
+            self._items.move_to_end(item['question_id'])
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def get(self, question_id):
+        with self._lock:
+            item = self._items.get(question_id)
+            if item is not None:
+                self._items.move_to_end(question_id)
+            return item
+
+
+result_cache = ResultCache()
+
+def rehydrate_results(results):
+    """Fills in the full fields of any compact results.
+
+    Items are taken from the result cache when possible; any others are
+    fetched from StackExchange, a page of up to _MAX_PAGE_SIZE ids per
+    request.
+
+    """
+    compact = [r for r in results if r.is_compact()]
+    missing = [str(r.question_id) for r in compact if result_cache.get(r.question_id) is None]
+    for start in range(0, len(missing), _MAX_PAGE_SIZE):
+        ids = missing[start:start + _MAX_PAGE_SIZE]
+        query = StackExchangeQuery('stackoverflow')
+        query.query_string.remove_param('tagged')
+        query.query_string.remove_param('nottagged')
+        query.query_string.add_param('pagesize', str(len(ids)))
+        query.set_query_path(QueryPaths.Questions)
+        for id in ids:
+            query.add_id(id)
+        try:
+            query.initiate()
+        except resilience.FAILURES as e:
+            # Shown without their full fields until StackExchange is back.
+            print("Could not fetch {} questions from StackExchange: {}".format(len(ids), e))
+    for r in compact:
+        # Questions that no longer exist are left with empty fields.
+        item = result_cache.get(r.question_id) or {'answer_count': 0, 'is_answered': False, 'tags': []}
+        r._fill(item)
+
+def results_in(values):
+    """Returns the question results among values, and in the responses and lists among them."""
+    results = []
+    for value in values:
+        if isinstance(value, QuestionResult):
+            results.append(value)
+        elif isinstance(value, StackExchangeResponse):
+            results.extend(value.results)
+        elif isinstance(value, list):
+            results.extend(results_in(value))
+    return results
+
+
 
 # STACK EXCHANGE QUERY PARAMETERS FOR ADVANCED SEARCH
 """
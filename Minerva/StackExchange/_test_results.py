@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+from urllib import parse
+import Query
+
+def _item(question_id):
+    return {'question_id': question_id, 'title': 'Question {}'.format(question_id),
+            'link': 'https://stackoverflow.com/q/{}'.format(question_id),
+            'answer_count': 1, 'is_answered': True, 'tags': ['ptvs'], 'body': 'Body {}'.format(question_id)}
+
+class _FakeResponse:
+    status_code = 200
+
+    def __init__(self, items):
+        self._items = items
+
+    def json(self):
+        return {'items': self._items}
+
+    def raise_for_status(self):
+        pass
+
+class _FakeStackExchange:
+
+    """Answers /questions/{ids} requests a page at a time, as StackExchange does."""
+
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, timeout=None):
+        url = parse.urlsplit(url)
+        ids = url.path.rsplit('/', 1)[1].split(';')
+        pagesize = int(dict(parse.parse_qsl(url.query)).get('pagesize', 30))
+        self.requests.append(ids)
+        return _FakeResponse([_item(int(id)) for id in ids[:pagesize]])
+
+class Test_CompactResults(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(Query, 'result_cache', Query.ResultCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_compactLeavesOutUnsetScore(self):
+        result = Query.QuestionResult(_item(1))
+        self.assertNotIn('combined_score', result.compact())
+        result.combined_score = 3
+        self.assertEqual(result.compact()['combined_score'], 3)
+
+    def test_rehydrateRoundTrip(self):
+        response = Query.StackExchangeResponse(None, json={'items': [_item(i) for i in range(150)]})
+        compact = response.compact()
+        self.assertNotIn('body', compact['items'][0])
+
+        # Rehydrated in another process, whose cache does not hold the items.
+        Query.result_cache = Query.ResultCache()
+        stackexchange = _FakeStackExchange()
+        with mock.patch.object(Query.requests, 'get', stackexchange.get):
+            restored = Query.StackExchangeResponse.from_compact(compact)
+            self.assertEqual(restored.results[149].tags, ['ptvs'])
+        self.assertEqual([len(ids) for ids in stackexchange.requests], [100, 50])
+        self.assertEqual([r.body for r in restored.results], ['Body {}'.format(i) for i in range(150)])
+        self.assertEqual(restored.results[0].title, 'Question 0')
+
+
+if __name__ == '__main__':
+    unittest.main()